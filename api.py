@@ -0,0 +1,244 @@
+"""Read-only HTTP API over the data of the app, for the tools that poll it.
+
+It answers from the same loaders and status cube as the app, without any
+Streamlit rerun:
+
+  GET /version                               version of the loaded data
+  GET /stations?date=2020-08-15              Qmj and status of every station on date
+  GET /reaches?date=...                      status of every reach
+  GET /units?date=...                        status of every management unit
+  GET /thresholds?date=...&threshold=DOE     stations under a threshold on date
+  GET /flows?stations=O7094010,...&start=2020-08-01&end=2020-08-15[&variable=qi]
+                                             flows of stations between two days
+
+date defaults to the last day of the Qmj. status is 0 without flow, 1 above
+every threshold, then 2 under the DOE, 3 under the DA and so on; it is null
+for the reaches and units without any station. Tables are JSON ({"version",
+"data": [records]}), or Arrow IPC streams with ?format=arrow or an Accept
+header of application/vnd.apache.arrow.stream. Every response has an ETag
+made of the data version and the request: a client sending it back in
+If-None-Match gets a 304 until new data is loaded. Bodies are kept in a
+shared cache keyed the same way.
+
+    python api.py [--port 8502]
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from utils import QMJ_STATIONS, THRESHOLDS, SharedCache, get_status_cube, load_sources
+
+API_PORT = int(os.environ.get('LVDLR_API_PORT', os.environ.get('PORT', 8502)))
+API_CACHE_MAX_BYTES = int(os.environ.get('LVDLR_API_CACHE_MB', 32)) * 1024**2
+# Longest window of flows served at once, in days
+MAX_FLOW_DAYS = int(os.environ.get('LVDLR_API_MAX_FLOW_DAYS', 366))
+ARROW = 'application/vnd.apache.arrow.stream'
+
+log = logging.getLogger('lvdlr.api')
+_responses = SharedCache(API_CACHE_MAX_BYTES)
+
+
+class BadRequest(Exception):
+    """Invalid query parameter, answered with a 400"""
+
+
+def _parse_day(query, name, default):
+    if name not in query:
+        return default
+    try:
+        return datetime.strptime(query[name], '%Y-%m-%d').date()
+    except ValueError:
+        raise BadRequest(f"{name} must be YYYY-MM-DD, not {query[name]!r}")
+
+
+def _day(query, sources):
+    return _parse_day(query, 'date', sources.qmj.matrix.index[-1])
+
+
+def _status_cube(sources):
+    return get_status_cube(sources.qmj, sources.stations, sources.hydro, sources.ug, list(THRESHOLDS.values()), QMJ_STATIONS)
+
+
+def stations_table(sources, query):
+    day = _day(query, sources)
+    cube = _status_cube(sources)
+    station_status = cube.window(day, 1)[0][:, 0]
+    qmj = sources.qmj.matrix.reindex(index=[day], columns=cube.station_codes).to_numpy(dtype=float)[0].round(4)
+    # Like on the map, only the Qmj of the stations of QMJ_STATIONS
+    qmj[~cube.station_codes.isin(QMJ_STATIONS)] = np.nan
+    table = sources.stations.table
+    return pd.DataFrame({'code': cube.station_codes, 'nom': table['NOM_COMPLET'].values, 'qmj': qmj, 'status': station_status})
+
+
+def _group_status(status):
+    # -1 of the features without any station, null like the NaN of get_hydro_status/get_ug_status
+    return pd.arrays.IntegerArray(status.astype(np.int8), status < 0)
+
+
+def reaches_table(sources, query):
+    hydro_status = _status_cube(sources).window(_day(query, sources), 1)[1][:, 0]
+    table = sources.hydro.table
+    return pd.DataFrame({'id': table['ID_hydrographie'].values, 'nom': table['TopoOH'].values, 'status': _group_status(hydro_status)})
+
+
+def units_table(sources, query):
+    ug_status = _status_cube(sources).window(_day(query, sources), 1)[2][:, 0]
+    table = sources.ug.table
+    return pd.DataFrame({'id': table['ID_ss-unite-gestion'].values, 'nom': table['UNITEGESTI'].values, 'status': _group_status(ug_status)})
+
+
+def thresholds_table(sources, query):
+    threshold = query.get('threshold', 'DOE')
+    if threshold not in THRESHOLDS:
+        raise BadRequest(f"threshold must be one of {', '.join(THRESHOLDS)}")
+    stations = stations_table(sources, query)
+    # Status 2 is under the DOE, 3 under the DA, and so on
+    under = stations['status'].values >= 2 + list(THRESHOLDS).index(threshold)
+    thresholds = sources.stations.table[THRESHOLDS[threshold]].values
+    return stations[under].assign(**{threshold: thresholds[under]}).reset_index(drop=True)
+
+
+def flows_table(sources, query):
+    variable = query.get('variable', 'qmj')
+    if variable not in ('qmj', 'qi') or getattr(sources, variable) is None:
+        raise BadRequest('variable must be qmj or qi')
+    stations = [s for s in query.get('stations', '').split(',') if s]
+    if not stations:
+        raise BadRequest('stations is required, e.g. stations=O7094010,O7001510')
+    end = _parse_day(query, 'end', sources.qmj.matrix.index[-1])
+    start = _parse_day(query, 'start', end - timedelta(6))
+    if not 0 <= (end - start).days < MAX_FLOW_DAYS:
+        raise BadRequest(f'start must be before end, at most {MAX_FLOW_DAYS} days before')
+    rows = getattr(sources, variable).index.select(stations, (start, end))
+    return pd.DataFrame({
+        'code_station': np.asarray(rows['code_station'], dtype=str),
+        # Days for Qmj, local times with their offset for Qi
+        'date': rows['date'].dt.date.values if variable == 'qmj' else rows['date'].array,
+        # The decimals of the CSV, i.e. the shortest repr of the float32 flows, rather than their float64 widening
+        'debit': rows['debit'].values.astype(str).astype(np.float64),
+    })
+
+
+TABLES = {
+    '/stations': stations_table,
+    '/reaches': reaches_table,
+    '/units': units_table,
+    '/thresholds': thresholds_table,
+    '/flows': flows_table,
+}
+
+
+def _json_default(value):
+    # Days, timestamps (with their offset) and NumPy scalars
+    if isinstance(value, np.generic):
+        return value.item()
+    return value.isoformat()
+
+
+def to_json(frame, version):
+    records = frame.astype(object).where(frame.notna(), None).to_dict(orient='records')
+    return json.dumps({'version': version, 'data': records}, ensure_ascii=False, default=_json_default).encode()
+
+
+def to_arrow(frame, version):
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'version': version.encode()})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def response(sources, path, query, form):
+    """(status, content type, body) of a GET, without its caching"""
+    if path == '/version':
+        return 200, 'application/json', json.dumps({'version': sources.version}).encode()
+    if path not in TABLES:
+        return 404, 'application/json', json.dumps({'error': f'unknown path {path}', 'paths': ['/version'] + list(TABLES)}).encode()
+    try:
+        frame = TABLES[path](sources, query)
+    except BadRequest as error:
+        return 400, 'application/json', json.dumps({'error': str(error)}).encode()
+    if form == 'arrow':
+        return 200, ARROW, to_arrow(frame, sources.version)
+    return 200, 'application/json', to_json(frame, sources.version)
+
+
+_sources_lock = threading.Lock()
+_sources = None
+
+
+def current_sources():
+    # The caches of the sources only check their mtimes, from one thread at a time
+    global _sources
+    with _sources_lock:
+        _sources = load_sources(parallel=_sources is None)
+        return _sources
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'lvdlr-api'
+    # Headers and body are two writes: without this, keep-alive clients wait for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        form = query.pop('format', None) or ('arrow' if ARROW in self.headers.get('Accept', '') else 'json')
+
+        sources = current_sources()
+        if sources.errors:
+            return self.send(503, 'application/json', json.dumps({'error': {name: str(error) for name, error in sources.errors.items()}}).encode())
+
+        request = f'{url.path}?{sorted(query.items())}&{form}'
+        etag = f'"{sources.version}-{hashlib.sha1(request.encode()).hexdigest()[:12]}"'
+        if etag in [tag.strip().lstrip('W/') for tag in self.headers.get('If-None-Match', '').split(',')]:
+            return self.send(304, None, b'', etag)
+        status, content_type, body = _responses.get((sources.version, request), lambda: response(sources, url.path, query, form))
+        self.send(status, content_type, body, etag if status == 200 else None)
+
+    def send(self, status, content_type, body, etag=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port=API_PORT):
+    current_sources()
+    server = Server(('', port), Handler)
+    log.info('serving on port %s', port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=API_PORT)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    serve(args.port)
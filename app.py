@@ -12,6 +12,8 @@ import time as tt
 from datetime import datetime, timedelta, date
 import pytz
 from utils import *
+from lowflow import *
+from snapshots import load_snapshot
 
 utc=pytz.UTC
 
@@ -22,59 +24,30 @@ def main():
     st.beta_set_page_config(layout="wide", page_icon="https://gitlab.makina-corpus.net/uploads/-/system/project/avatar/1376/Logo.png?width=64",
     page_title="La Vie De La Rivière")
 
-    # Read all needed data
-    ug_filename = 'data/ss-unites-gestion.geojson'
-    map_ug = gpd.read_file(ug_filename)
-    hydro_filename = 'data/hydrographie.geojson'
-    map_hydro = gpd.read_file(hydro_filename)
-    stations_filename = 'data/stations.geojson'
-    map_stations = gpd.read_file(stations_filename)
+    # Read all needed data, all sources at once
+    stage('load')
+    sources = load_sources()
+    for name, error in sources.errors.items():
+        st.error(f"Impossible de charger {DATA_SOURCES[name][0]} : {error}")
+    ## Only the Qi can be missing, its view is then left out
+    if any(name != 'qi' for name in sources.errors):
+        st.stop()
+    ug_layer, hydro_layer, stations_layer = sources.ug, sources.hydro, sources.stations
+    map_stations = stations_layer.frame()
 
-    data_qmj = get_qmj('data/hbv_qmj.csv')
-    data_qi = get_qi('data/hbv_qi.csv')
+    stage('reshape')
+    qmj_matrix = sources.qmj.matrix
 
     # Initiate useful variables
     river_theme_color = ['#57A0D3', '#4F97A3', '#7285A5', '#73C2FB', '#008081', '#4C516D', '#6593F5', '#008ECC', '#95C8D8', '#4682B4', '#0F52BA', '#0080FF']
 
     threshold_colors=['#828282', '#88CE33','#F5DC0B','#F5860B','#E53E1D', '#000000']
 
-    threshold_value_dict = {
-        'DOE': 2,
-        'DA': 3,
-        'DAR': 4,
-        'DC': 5
-    }
-
-    threshold_value_dict = {
-        'DOE': 2,
-        'DA': 3,
-        'DAR': 4,
-        'DC': 5
-    }
+    ## Status code of each threshold of THRESHOLDS: 2 under the DOE, 3 under the DA, and so on
+    threshold_value_dict = {name: value for value, name in enumerate(THRESHOLDS, 2)}
 
-    threshold_name_dict = {
-        'DOE': 'Q_Obj_m3',
-        'DA': 'Q_80pDOE_m3',
-        'DAR': 'Q_alerte_renf',
-        'DC': 'Q_Crise_m3'
-    }
-
-    lot_amont = ['O7001510','O7021530','O7041510','O7101510','O7161510_E','O7191510']
-    colagne = ['O7054010','O7074020','O7094010']
-    lot_domanial = ['O7701540','O7971510','O8231530','COUTET','O8661520']
-    cele = ['O8113520','O8133520']
 
-    rivers = {
-        'Lot amont': lot_amont,
-        'Colagne': colagne, 
-        'Lot domanial': lot_domanial, 
-        'Célé': cele
-    }
-
-    qi_stations = data_qi['code_station'].unique()
-    qmj_stations = data_qmj['code_station'].unique()
-
-    stations_qmj_list = ['O6140010','O9000010','O8584010','O8394310','O8344020','O8255010','O8264010','O8113520','O8133520','O7434010','O7354010','O7635010','O7265010','O7234030','O7234010','O7272510','O7202510','O7410401','O7444010','O7245010','GOUL','O7515510','O7535010','O7094010','O7054010','O7074020','O7085010','O7874010','O7825010','O7944020','O7145220','O7035010','O7001510','O7041510','O7101510','O7191510','O7161510_E','O7021530','O7015810','O8661520','COUTET','CAHEDF','O8231530','ENTEDF','O7701540','O7971510']
+    stations_qmj_list = list(QMJ_STATIONS)
 
     # Select variable to visualize
     marginleft, contentcol, marginright = st.beta_columns([1,13,1])
@@ -83,29 +56,37 @@ def main():
 Explorateur des données des rivières du bassin du Lot
         """
     
-        var_type = st.radio('Sélectionnez la variable à visualiser', ['Débit moyen journalier (Qmj)', 'Débit instantané (Qi)'])
+        var_types = ['Débit moyen journalier (Qmj)'] + (['Débit instantané (Qi)'] if sources.qi is not None else [])
+        var_type = st.radio('Sélectionnez la variable à visualiser', var_types)
 
+        ## The store rows are shared read-only by all sessions, and used without copying them
         if var_type == 'Débit moyen journalier (Qmj)':
             title = 'Débit moyen journalier'
-            data = data_qmj.copy()
+            data_matrix = qmj_matrix
+            data_index = sources.qmj.index
+            data_version = sources.qmj.version
         elif var_type == 'Débit instantané (Qi)':
             title = 'Débit instantané'
-            data = data_qi.copy()
+            data_matrix = sources.qi.matrix
+            qi_pyramid = sources.qi.pyramid
+            data_index = qi_pyramid.base
+            data_version = sources.qi.version
 
     # Explore Qmj data
+    stage('reshape')
     marginleft, col_select_qmj, marginmiddle, col_display_qmj, marginright = st.beta_columns([1,3,1,9,1])
     
     with col_select_qmj:
         ## Select Qmj stations for visualization
-        stations = data['code_station'].unique()
+        stations = list(data_index.stations)
         selected_stations = st.multiselect('Sélectionnez une ou plusieurs stations', stations)
 
         if not selected_stations:
             st.warning('Renseignez au moins une station.')
             st.stop()
 
-        ## Subset data for selected stations
-        data = data.loc[data['code_station'].isin(selected_stations)]
+        ## Subset data for selected stations, i.e. one contiguous slice per station
+        data = data_index.select(selected_stations)
 
         ## Display sliders to filter data subset
         ### Flow slider
@@ -118,13 +99,9 @@ Explorateur des données des rivières du bassin du Lot
             value=(min_flow, max_flow)
             )
 
-        ### Date slider
-        min_date = data['date'].min()
-        max_date = data['date'].max()
-
-        if var_type == 'Débit instantané (Qi)':
-            max_date = date(max_date.year, max_date.month, max_date.day)
-            min_date = date(min_date.year, min_date.month, min_date.day)
+        ### Date slider, in days (local days for Qi)
+        min_date = data['date'].min().date()
+        max_date = data['date'].max().date()
 
         date_slider = st.slider(
             'Intervalle de dates à visualiser',
@@ -134,17 +111,32 @@ Explorateur des données des rivières du bassin du Lot
             format="DD/MM/YYYY"
             )
 
-    ## Display qmj data in line chart
-    with col_display_qmj:
+        all_points = st.checkbox('Afficher tous les points (sans sous-échantillonnage)')
+
+    ## Display qmj data in line chart, built again only when its own inputs change
+    stage('charts')
+    def flow_chart():
+        ### Only the rows within the selected dates and flows are sent to the chart,
+        ### capped according to its width unless asked otherwise
+        ### Qi is read from the coarsest level of its pyramid still giving a point per pixel
+        if var_type == 'Débit instantané (Qi)' and not all_points:
+            chart_data = qi_pyramid.select(selected_stations, date_range=date_slider)
+        else:
+            chart_data = data_index.select(selected_stations, date_range=date_slider)
+        if not all_points:
+            chart_data = downsample(chart_data, date_range=date_slider)
+        chart_data = filter_flows(chart_data, flow_slider)
+
         ### Allow legend filter
-        selection = alt.selection_multi(fields=['code_station'], bind='legend')
+        ### Selections are named so that the spec is the same each time the chart is built
+        selection = alt.selection_multi(fields=['code_station'], bind='legend', name='legende')
 
         ### Get threshold flow values. If they exist, and only station is selected, they are display on the chart.
-        DOE, DA, DAR, DC = get_threshold(map_stations, threshold_name_dict, selected_stations)
+        DOE, DA, DAR, DC = get_threshold(map_stations, THRESHOLDS, selected_stations)
 
         if len(selected_stations) == 1 and not np.isnan(DOE):
             ### Line chart of flow
-            qmj_line = alt.Chart().mark_line().encode(
+            qmj_line = alt.Chart().mark_line(clip=True).encode(
                 x=alt.X('date:T', axis=alt.Axis(domain=False, format='%_d/%m/%Y'), title=None, scale=alt.Scale(domain=(date_slider[0].strftime('%Y-%m-%d'), date_slider[1].strftime('%Y-%m-%d')))),
                 y=alt.Y('debit:Q', title='débit [m3]', scale=alt.Scale(domain=(flow_slider[0], flow_slider[1]))),
                 color=alt.value('#57A0D3'),
@@ -167,20 +159,20 @@ Explorateur des données des rivières du bassin du Lot
 
             ### Agregate Line chart and horizontal lines into one single chart
             qmj_all = alt.layer(
-                qmj_line, aggregates,
-                data=data
+                *flow_band(chart_data, alt.value('#57A0D3')), qmj_line, aggregates,
+                data=chart_data
             ).transform_calculate(
                 DOE=f"{DOE}",
                 DA=f"{DA}",
                 DAR=f"{DAR}",
                 DC=f"{DC}"
-            ).interactive().properties(
+            ).interactive(name='zoom').properties(
                 height=500
             )
 
         else:
             ### If ther more than one station selected, only display flow values
-            qmj_line = alt.Chart().mark_line().encode(
+            qmj_line = alt.Chart().mark_line(clip=True).encode(
                 x=alt.X('date:T', axis=alt.Axis(domain=False, format='%_d/%m/%Y'), title=None, scale=alt.Scale(domain=(date_slider[0].strftime('%Y-%m-%d'), date_slider[1].strftime('%Y-%m-%d')))),
                 y=alt.Y('debit:Q', title='débit [m3]', scale=alt.Scale(domain=(flow_slider[0], flow_slider[1]))),
                 color=alt.Color('code_station:N', title='Code station', scale=alt.Scale(domain=selected_stations,range=river_theme_color)),
@@ -192,23 +184,26 @@ Explorateur des données des rivières du bassin du Lot
                 selection
             )
             qmj_all = alt.layer(
-                qmj_line,
-                data=data
-            ).interactive().properties(
+                *flow_band(chart_data, alt.Color('code_station:N', legend=None, scale=alt.Scale(domain=selected_stations,range=river_theme_color))), qmj_line,
+                data=chart_data
+            ).interactive(name='zoom').properties(
                 height=500
             )
+        return ChartSpec(qmj_all)
+
+    with col_display_qmj:
+        qmj_all = get_section('débits', (data_version, stations_layer.mtime, tuple(selected_stations), flow_slider, date_slider, all_points), flow_chart)
 
         ### Display flow chart
-        st.altair_chart(qmj_all, use_container_width=True)
+        show_altair_chart(qmj_all, 'débits', use_container_width=True)
 
     marginleft, contentcol, marginright = st.beta_columns([1,13,1])
     ## Display raw data if checkbox if checked
     with contentcol:
-        with st.beta_expander("Voir les données brutes"):
+        if st.checkbox("Voir les données brutes"):
             st.subheader(f'Données de débit moyen journalier (Qmj), {print_stations(selected_stations)}')
-            ### Reshape data to ease raw data visualization
-            frames = [process_stations(station, data) for station in selected_stations]
-            data_selected_viz = pd.concat(frames, axis=1)
+            ### Slice the precomputed (date x station) matrix to ease raw data visualization
+            data_selected_viz = data_matrix[selected_stations].dropna(how='all')
 
             ### and display
             data_selected_viz
@@ -222,68 +217,40 @@ Explorateur des données des rivières du bassin du Lot
     with col_select:
         ## Select the day of visualization
         value_date_input = date_slider[1]
-        if value_date_input>data_qmj['date'].max():
-            value_date_input = data_qmj['date'].max()
+        if value_date_input>qmj_matrix.index[-1]:
+            value_date_input = qmj_matrix.index[-1]
         date_qmj = st.date_input(
             'Choisir une date',
             value=value_date_input
             )
-
-    ## Reshape data to ease qmj selection
-    frames = [process_stations(station, data_qmj) for station in qmj_stations]
-    reshape_data = pd.concat(frames, axis=1)
-
-    ## Concat stations with their corresponding qmj
-    rename_col_dict = {
-        date_qmj: date_qmj.strftime('%_d/%m/%Y'),
-        date_qmj-timedelta(1): (date_qmj-timedelta(1)).strftime('%_d/%m/%Y'),
-        date_qmj-timedelta(2): (date_qmj-timedelta(2)).strftime('%_d/%m/%Y'),
-        date_qmj-timedelta(3): (date_qmj-timedelta(3)).strftime('%_d/%m/%Y'),
-        date_qmj-timedelta(4): (date_qmj-timedelta(4)).strftime('%_d/%m/%Y'),
-        date_qmj-timedelta(5): (date_qmj-timedelta(5)).strftime('%_d/%m/%Y'),
-        date_qmj-timedelta(6): (date_qmj-timedelta(6)).strftime('%_d/%m/%Y'),
-    }
-
-    map_stations = pd.concat([map_stations.set_index('COD_STAT'),reshape_data.loc[[date_qmj-timedelta(d) for d in range(0,7)]][stations_qmj_list].T.round(4)], axis=1).rename(columns=rename_col_dict)
-    
-    ## Compute status given the qmj and the corresponding flow thresholds
-    for d in range(0,7):
-        dd = date_qmj-timedelta(d)
-
-        ### For stations
-        map_stations[f"{dd.strftime('%_d/%m/%Y')}-status"] = [get_station_status(row[0], row[1], row[2], row[3], row[4]) for row in map_stations[[f"{dd.strftime('%_d/%m/%Y')}", 'Q_Obj_m3', 'Q_80pDOE_m3', 'Q_alerte_renf', 'Q_Crise_m3']].to_numpy()]
-
-        ### For hydro
-        map_hydro[f"{dd.strftime('%_d/%m/%Y')}-status"] = [get_hydro_status(x, map_stations[f"{dd.strftime('%_d/%m/%Y')}-status"], map_stations['ID_hydrographie']) for x in map_hydro['ID_hydrographie']]
-
-        ### For management units
-        map_ug[f"{dd.strftime('%_d/%m/%Y')}-status"] = [get_ug_status(x, map_hydro[f"{dd.strftime('%_d/%m/%Y')}-status"], map_hydro['ID_ss-unite-gestion']) for x in map_ug['ID_ss-unite-gestion']]
-    
-    ## Associate color to the status
-    map_stations['color'] = map_stations[f"{date_qmj.strftime('%_d/%m/%Y')}-status"].apply(get_status_color)
-    map_stations['color_stroke'] = [get_status_color(x, 'hydro') for x in map_stations[f"{date_qmj.strftime('%_d/%m/%Y')}-status"]]
-    map_hydro['color'] = [get_status_color(x, 'hydro') for x in map_hydro[f"{date_qmj.strftime('%_d/%m/%Y')}-status"]]
-    map_ug['color'] = [get_status_color(x, 'ug') for x in map_ug[f"{date_qmj.strftime('%_d/%m/%Y')}-status"]]
-
-    map_stations.reset_index(inplace=True)
-
-    ## Give the opportuniy to filter given the selected stations
-    with col_select:
-        if st.checkbox("Filtrer selon les stations sélectionnées"):
-            ### Filter the data what will be display on map
-            map_stations = map_stations.loc[map_stations['index'].isin(selected_stations)]
-            ### And write the qmj for the selected stations
+        ## Zoom of the map, which also picks the level of detail of the geometries sent to it
+        map_zoom = st.slider('Zoom de la carte', min_value=6, max_value=13, value=7)
+        ## Step the map through the days before the chosen one
+        animate = st.button('Animer les 30 jours précédents')
+
+        ## Give the opportuniy to filter given the selected stations
+        filter_stations = st.checkbox("Filtrer selon les stations sélectionnées")
+
+    ## Stations with their qmj and status on the 7 last days, and colors of the map
+    stage('status')
+    ### Read from the status cube, and computed once for all sessions per date and filter
+    status_cube = get_status_cube(sources.qmj, stations_layer, hydro_layer, ug_layer, list(THRESHOLDS.values()), stations_qmj_list)
+    filter_key = tuple(selected_stations) if filter_stations else None
+    ### Days pre-rendered by prerender.py are read from its store instead
+    load_snapshot(status_cube, date_qmj)
+    qmj_window, map_stations, hydro_colors, ug_colors = get_basin_state(stations_layer, qmj_matrix, status_cube, stations_qmj_list, date_qmj, selected_stations if filter_stations else None)
 
     marginleft, contentcol, marginright = st.beta_columns([1,13,1])
     with contentcol:
-        with st.beta_expander(f"Voir le débit moyen pour les stations sélectionnées au {date_qmj.strftime('%_d/%m/%Y')}"):
+        if st.checkbox(f"Voir le débit moyen pour les stations sélectionnées au {date_qmj.strftime('%_d/%m/%Y')}"):
             for station in selected_stations:
-                value = reshape_data.loc[date_qmj][station].round(4)
+                value = qmj_window.at[date_qmj, station]
                 col = threshold_colors[map_stations.loc[map_stations['index']==station][f"{date_qmj.strftime('%_d/%m/%Y')}-status"].iloc[0]]
                 st.markdown(f"à la station {station} : **<span style='color: {col}'>{value}</span>** m3",unsafe_allow_html=True)
     ## Map Data
+    stage('map build')
     ## Get the center of the map given the spatial repartition of the hydrometry
-    bbox = map_hydro.total_bounds
+    bbox = hydro_layer.bounds
     midpoint = [(bbox[1]+bbox[3])/2, (bbox[0]+bbox[2])/2]
 
     ## Prepare Tooltip template for the map
@@ -304,52 +271,64 @@ Explorateur des données des rivières du bassin du Lot
             "color": "white"
     }
     }
+    ### Only the fields of the tooltip and the colors are sent with the stations
+    station_tooltip_columns = ['index', 'NOM_COMPLET', 'Q_Obj_m3', 'Q_80pDOE_m3', 'Q_alerte_renf', 'Q_Crise_m3', 'color', 'color_stroke']
 
     with col_display_map:
-        ## Create the map and display
-        st.pydeck_chart(pdk.Deck(
-            map_style="mapbox://styles/mapbox/light-v9",
-            initial_view_state={
-                "latitude": midpoint[0],
-                "longitude": midpoint[1],
-                "zoom": 7,
-            },
-            tooltip=tooltip_template,
-            layers=[
-                pdk.Layer(
-                    "GeoJsonLayer",
-                    data=map_ug,
-                    stroked=True,
-                    filled = True,
-                    get_fill_color="color",
-                    getLineColor=[120,120,120,150],
-                    getLineWidth=200,
-                    pickable=False,
-                ),
-                pdk.Layer(
-                    "GeoJsonLayer",
-                    data=map_hydro,
-                    getLineColor="color",
-                    getLineWidth=500,
-                    pickable=False,
-                ),
-                pdk.Layer(
-                    "GeoJsonLayer",
-                    data=map_stations,
-                    filled = True,
-                    stroked = True,
-                    get_fill_color="color",
-                    getLineColor="color_stroke",
-                    get_radius=2000,
-                    getLineWidth=1000,
-                    pickable=True,
-                    auto_highlight=True,
-                    highlightColor=[250, 0, 100],
-                ),
-            ],
-        ))
+        ## Create the map, rebuilt only when the day, the filter or the zoom change
+        def map_deck(map_stations, hydro_colors, ug_colors):
+            return pdk.Deck(
+                map_style="mapbox://styles/mapbox/light-v9",
+                initial_view_state={
+                    "latitude": midpoint[0],
+                    "longitude": midpoint[1],
+                    "zoom": map_zoom,
+                },
+                tooltip=tooltip_template,
+                layers=[
+                    pdk.Layer(
+                        "GeoJsonLayer",
+                        data=ug_layer.colored(zoom=map_zoom, color=ug_colors),
+                        stroked=True,
+                        filled = True,
+                        get_fill_color="color",
+                        getLineColor=[120,120,120,150],
+                        getLineWidth=200,
+                        pickable=False,
+                    ),
+                    pdk.Layer(
+                        "GeoJsonLayer",
+                        data=hydro_layer.colored(zoom=map_zoom, color=hydro_colors),
+                        getLineColor="color",
+                        getLineWidth=500,
+                        pickable=False,
+                    ),
+                    pdk.Layer(
+                        "GeoJsonLayer",
+                        data=stations_layer.to_pydeck(map_stations.set_index(map_stations['index']), columns=station_tooltip_columns, key='COD_STAT'),
+                        filled = True,
+                        stroked = True,
+                        get_fill_color="color",
+                        getLineColor="color_stroke",
+                        get_radius=2000,
+                        getLineWidth=1000,
+                        pickable=True,
+                        auto_highlight=True,
+                        highlightColor=[250, 0, 100],
+                    ),
+                ],
+            )
+        map_frame = st.empty()
+        if animate:
+            for day in [date_qmj-timedelta(d) for d in range(29, 0, -1)]:
+                load_snapshot(status_cube, day)
+                _, day_stations, day_hydro_colors, day_ug_colors = get_basin_state(stations_layer, qmj_matrix, status_cube, stations_qmj_list, day, selected_stations if filter_stations else None)
+                map_frame.pydeck_chart(map_deck(day_stations, day_hydro_colors, day_ug_colors))
+                tt.sleep(0.3)
+        show_pydeck_chart(get_section('carte', (status_cube.day_version(date_qmj), date_qmj, filter_key, map_zoom), lambda: map_deck(map_stations, hydro_colors, ug_colors)), 'carte', placeholder=map_frame)
 
     # Table of stations under a given threshold on the day of visualization
+    stage('charts')
     with contentcol:
         f"### Table des stations sous un débit seuil au {date_qmj.strftime('%_d/%m/%Y')}"
 
@@ -358,40 +337,20 @@ Explorateur des données des rivières du bassin du Lot
     with col_select:
         threshold = st.radio(
             'Choisir un seuil',
-            options=['DOE', 'DA', 'DAR', 'DC']
+            options=list(THRESHOLDS)
+            )
+        history_days = st.radio(
+            "Choisir la période d'historique",
+            options=list(HISTORY_DAYS),
+            format_func=lambda d: f'{d} jours'
             )
 
-    threshold_table = map_stations[map_stations[f"{date_qmj.strftime('%_d/%m/%Y')}-status"]>=threshold_value_dict[threshold]][['index','NOM_COMPLET',f"{date_qmj.strftime('%_d/%m/%Y')}",threshold_name_dict[threshold],'hydrographie','UG','Unite_Gestion']].rename(columns={'NOM_COMPLET': 'nom complet',f"{date_qmj.strftime('%_d/%m/%Y')}": f'QMJ {date_qmj} [m3]', threshold_name_dict[threshold]: f'{threshold} [m3]','Unite_Gestion': 'unité de gestion'}).set_index('index')
-
-    source = pd.DataFrame(columns=['stations', 'day', 'status'])
-    
-    for row in map_stations[map_stations[f"{date_qmj.strftime('%_d/%m/%Y')}-status"]>=threshold_value_dict[threshold]].itertuples(index=False):
-        for i in range(0,7):
-            source = source.append({'stations': row[0], 'day': date_qmj-timedelta(i), 'status': row[i+28]}, ignore_index=True)
-
-    heatmap = alt.Chart(source).mark_square(size=400).encode(
-        x=alt.X('day:T', scale=alt.Scale(domain=((date_qmj-timedelta(7.25)).strftime('%Y-%m-%d'), (date_qmj+timedelta(1)).strftime('%Y-%m-%d')))),
-        y='stations:N',
-        color=alt.Color('status:O', legend=alt.Legend(title='Débits seuils franchis'), scale=alt.Scale(domain=['0','1', '2', '3', '4', '5'], range=['#828282', '#88CE33','#F5DC0B','#F5860B','#E53E1D', '#000000'])),
-        tooltip=[
-            alt.Tooltip('stations:N', title='Station'),
-            alt.Tooltip('day:T', title='Date'),
-            alt.Tooltip('status:Q', title='Status'),
-        ]
-    ).properties(
-        width=430,
-        height=len(source['stations'].unique())*25+60
-    ).configure_axis(
-        grid=False
-    ).configure_view(
-        strokeWidth=0
-    )
-
-    
+    threshold_table, source = get_threshold_state(map_stations, status_cube, date_qmj, threshold, THRESHOLDS[threshold], threshold_value_dict[threshold], history_days, selected_stations if filter_stations else None)
 
     with col_display_table:
+        ## Heatmap of the history, rebuilt only when its inputs change
         if len(source)>0:
-            st.altair_chart(heatmap)
+            show_altair_chart(get_threshold_heatmap(source, status_cube, date_qmj, threshold, history_days, filter_key), 'historique des seuils')
         else:
             st.write(f"*Aucune station sous le {threshold}*")
 
@@ -400,76 +359,14 @@ Explorateur des données des rivières du bassin du Lot
     with contentcol:
         ## Example of combined charts
         '### Visualisations combinées'
-        scale = alt.Scale(domain=['0','1', '2', '3', '4', '5'],
-                        range=['#828282', '#88CE33','#F5DC0B','#F5860B','#E53E1D', '#000000'])
-        color = alt.Color(f"{date_qmj.strftime('%_d/%m/%Y')}-status:N", scale=scale)
-
-        ## We create two selections:
-        ## - a brush that is active on the top panel
-        ## - a multi-click that is active on the bottom panel
-        brush = alt.selection(type='interval') #alt.selection_interval(encodings=['x'])
-        click = alt.selection_multi(encodings=['color'])
-
-        ## Top panel is scatter plot of hydrometric stations given their longitude and latitude
-        points = alt.Chart().mark_circle().encode(
-            alt.X('X_LONG_E:Q', title='Longitude'),
-            alt.Y('Y_LAT_N:Q', title='Latitude', scale=alt.Scale(domain=[bbox[1]-0.05,bbox[3]+0.05])),
-            color=alt.condition(brush, color, alt.value('lightgray')),
-            size=alt.Size(f"{date_qmj.strftime('%_d/%m/%Y')}:Q", scale=alt.Scale(range=[20, 300])),
-            tooltip=['index',f"{date_qmj.strftime('%_d/%m/%Y')}"],
-        ).properties(
-            width=550,
-            height=300
-        ).add_selection(
-            brush
-        ).transform_filter(
-            click
-        )
-
-        ## Bottom panel is a bar chart giving the distibution of the stations according to their status
-        bars = alt.Chart().mark_bar().encode(
-            x=alt.X('count()', title='Nombre de stations par intervalle de seuils'),
-            y=alt.Y(f"{date_qmj.strftime('%_d/%m/%Y')}-status:N", scale=alt.Scale(domain=[0, 1, 2, 3, 4, 5]), title='Seuils'),
-            color=alt.condition(click, color, alt.value('lightgray')),
-        ).transform_filter(
-            brush
-        ).properties(
-            width=550,
-        ).add_selection(
-            click
-        )
-
-        ## Concat and display the charts
-        bars_points = alt.vconcat(
-            points,
-            bars,
-            data=map_stations.drop(columns={'geometry'}),
-            title="Situation du bassin"
-        ).configure_axis(
-            grid=False
-        )
-        st.altair_chart(bars_points, use_container_width=True)
+
+        ## Built only when the day or the filter change
+        show_altair_chart(get_basin_chart(map_stations, status_cube, date_qmj, hydro_layer.bounds, filter_key), 'situation du bassin', use_container_width=True)
 
 
         # Try a new visualization kind : stations on a given river
         "### Stations le long d'un cours d'eau"
-        ## Reshape to ease manipulation
-        frames_river = [process_rivers(river, map_stations, rivers) for river in rivers.keys()]
-        map_stations_river = pd.concat(frames_river, ignore_index=True, sort=False)
-
-        ## Create chart
-        river_chart = alt.Chart(map_stations_river).mark_circle().encode(
-            alt.X('river_name:O', title='Rivières', axis=alt.Axis(labelAngle=0, orient="top")),
-            alt.Y('index:O', title=''),
-            color=color,
-            size=alt.Size(f"{date_qmj.strftime('%_d/%m/%Y')}:Q", scale=alt.Scale(range=[20, 500])),
-            tooltip=['COD_STAT',f"{date_qmj.strftime('%_d/%m/%Y')}"],
-        ).properties(
-            height=400
-        )
-
-        ## and display
-        st.altair_chart(river_chart, use_container_width=True)
+        show_altair_chart(get_river_chart(get_topology(stations_layer, hydro_layer, ug_layer), map_stations, status_cube, date_qmj, filter_key), 'cours d\'eau', use_container_width=True)
 
         # # Pie chart are useful for global overview of share
         # # Not available with Altair so this one is a try with Bokeh
@@ -503,6 +400,50 @@ Explorateur des données des rivières du bassin du Lot
         # st.bokeh_chart(p)
 
 
+    # Low-flow indicators of the selected stations over the whole Qmj history
+    stage('charts')
+    lowflow_stats = get_lowflow_stats(sources.qmj, stations_layer)
+    lowflow_stations = [station for station in selected_stations if station in lowflow_stats.stations]
+
+    marginleft, contentcol, marginright = st.beta_columns([1,13,1])
+    with contentcol:
+        "## Étiages des stations sélectionnées"
+        if not lowflow_stations:
+            st.write("*Aucune station sélectionnée n'a de Qmj*")
+        else:
+            ## VCN3, VCN10, QMNA and days under each threshold, per station and year
+            st.dataframe(lowflow_stats.frame(lowflow_stations).set_index(['station', 'année']).round(3))
+
+    if lowflow_stations:
+        marginleft, col_select, marginmiddle, col_display_lowflow, marginright = st.beta_columns([1,3,1,9,1])
+
+        with col_select:
+            lowflow_station = st.radio("Choisir la station", options=lowflow_stations)
+            lowflow_years = [int(year) for year in lowflow_stats.years[::-1]]
+            lowflow_year = st.selectbox("Choisir l'année", options=lowflow_years, index=lowflow_years.index(date_qmj.year) if date_qmj.year in lowflow_years else 0)
+
+        ## Days under each threshold since the 1st of January, up to the day of the map in its year
+        def lowflow_chart():
+            days_below = lowflow_stats.days_below([lowflow_station], lowflow_year, until=date_qmj if lowflow_year == date_qmj.year else None)
+            if len(days_below) == 0:
+                return None
+            return ChartSpec(alt.Chart(days_below).mark_line(interpolate='step-after').encode(
+                x=alt.X('day:T', axis=alt.Axis(format='%_d/%m/%Y'), title=None),
+                y=alt.Y('jours:Q', title='Jours sous le seuil depuis le 1er janvier'),
+                color=alt.Color('seuil:N', title='Débits seuils', scale=alt.Scale(domain=['DOE', 'DA', 'DAR', 'DC'], range=threshold_colors[1:])),
+                tooltip=['seuil', alt.Tooltip('day:T', title='Date'), 'jours'],
+            ).properties(
+                height=300
+            ))
+
+        with col_display_lowflow:
+            lowflow_days = get_section('étiages', (lowflow_stats.version, lowflow_station, lowflow_year, date_qmj), lowflow_chart)
+            if lowflow_days is not None:
+                show_altair_chart(lowflow_days, 'étiages', use_container_width=True)
+            else:
+                st.write(f"*Pas de débits seuils pour la station {lowflow_station}*")
+
+
     ## This code is not useful anymore but kept here, in case it's needed again
     # max_date_qi = st.date_input('Sélectionner la date de fin de la visualisation', min_value=data_qi_selected['date'].min().date(), max_value=data_qi_selected['date'].max().date())
     # delta = st.radio("Choisir une période de visualisation",options=["7 jours", "15 jours", "1 mois", "2 mois", "3 mois"])
@@ -522,4 +463,4 @@ Explorateur des données des rivières du bassin du Lot
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    profile_run(main)
\ No newline at end of file
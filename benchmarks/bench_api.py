@@ -0,0 +1,106 @@
+"""Load test of api.py: requests per second and latencies with a local client.
+
+The API runs in its own process, as next to the web process, and client
+threads send requests over keep-alive connections for a few seconds per
+case. Client and server share the cores of the machine: on one core the
+figures are a floor for the server alone.
+
+Cases: a cached JSON table, the same with If-None-Match (304), Qmj flows
+as Arrow, Qi flows as JSON and as Arrow, and a different day on each
+request, so that every one is computed.
+
+    python -m benchmarks.bench_api [--clients 8] [--seconds 3]
+"""
+import argparse
+import http.client
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+FIRST_DAY = date(2019, 1, 1)
+
+
+def wait_until_up(port, timeout=120):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        try:
+            connection = http.client.HTTPConnection('localhost', port, timeout=5)
+            connection.request('GET', '/version')
+            connection.getresponse().read()
+            return time.perf_counter() - start
+        except (ConnectionError, socket.timeout):
+            time.sleep(0.2)
+    raise RuntimeError(f'api.py did not answer on port {port}')
+
+
+def client(port, paths, headers, until, latencies, statuses):
+    connection = http.client.HTTPConnection('localhost', port)
+    while time.perf_counter() < until:
+        path = next(paths)
+        start = time.perf_counter()
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        statuses.add(response.status)
+    connection.close()
+
+
+def run(port, name, paths, headers, clients, seconds):
+    latencies, statuses = [], set()
+    until = time.perf_counter() + seconds
+    threads = [threading.Thread(target=client, args=(port, paths, headers, until, latencies, statuses)) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1e3
+    print(f'{name:<42}{len(latencies) / elapsed:8.0f} req/s   p50 {p50:6.1f} ms   p99 {p99:6.1f} ms   {sorted(statuses)}')
+
+
+class Cycle:
+    # Thread-safe endless iterator over paths
+    def __init__(self, paths):
+        self.paths, self.i, self.lock = paths, 0, threading.Lock()
+
+    def __next__(self):
+        with self.lock:
+            self.i += 1
+            return self.paths[self.i % len(self.paths)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--port', type=int, default=8599)
+    args = parser.parse_args()
+
+    server = subprocess.Popen([sys.executable, 'api.py', '--port', str(args.port)], stdout=subprocess.DEVNULL)
+    try:
+        print(f'api.py up in {wait_until_up(args.port):.1f} s, {args.clients} client threads')
+        connection = http.client.HTTPConnection('localhost', args.port)
+        connection.request('GET', '/stations')
+        response = connection.getresponse()
+        response.read()
+        etag = response.getheader('ETag')
+
+        cold_days = Cycle([f'/stations?date={FIRST_DAY + timedelta(i)}' for i in range(600)])
+        run(args.port, 'stations, cached JSON', Cycle(['/stations']), {}, args.clients, args.seconds)
+        run(args.port, 'stations, If-None-Match (304)', Cycle(['/stations']), {'If-None-Match': etag}, args.clients, args.seconds)
+        run(args.port, 'flows of 2 stations, 30 days, Arrow', Cycle(['/flows?stations=O7094010,O7001510&start=2020-08-01&end=2020-08-30&format=arrow']),
+            {}, args.clients, args.seconds)
+        qi_flows = '/flows?stations=O7094010&start=2020-10-01&end=2020-10-14&variable=qi'
+        run(args.port, 'Qi flows of a station, 14 days, JSON', Cycle([qi_flows]), {}, args.clients, args.seconds)
+        run(args.port, 'Qi flows of a station, 14 days, Arrow', Cycle([f'{qi_flows}&format=arrow']), {}, args.clients, args.seconds)
+        run(args.port, 'stations, a new day on every request', cold_days, {}, args.clients, args.seconds)
+    finally:
+        server.terminate()
+        server.wait()
@@ -0,0 +1,58 @@
+"""Chart bytes per rerun of a session: what the charts weigh, and what goes over the wire.
+
+A session changes one widget at a time, like a user exploring the app.
+Streamlit sends a chart again only when its message differs from those the
+browser got in its last runs, so the bytes on the wire are those of the
+charts that changed. Reported per rerun: the time of the chart stages, the
+bytes of all the charts shown, and the bytes actually sent.
+
+    python -m benchmarks.bench_chart_payload [--scale 10]
+"""
+import argparse
+from datetime import date
+
+from benchmarks import headless
+from benchmarks.bench_main import STATIONS, VARIABLE, QI
+
+DATE, THRESHOLD, HISTORY, FILTER = 'Choisir une date', 'Choisir un seuil', "Choisir la période d'historique", 'Filtrer selon les stations sélectionnées'
+
+
+def session():
+    widgets = {STATIONS: ['O7094010']}
+    yield 'first run', dict(widgets)
+    yield 'same widgets', dict(widgets)
+    widgets[THRESHOLD] = 'DA'
+    yield 'threshold DA', dict(widgets)
+    widgets[HISTORY] = 30
+    yield '30 days of history', dict(widgets)
+    widgets[DATE] = date(2020, 8, 15)
+    yield 'date 15/08/2020', dict(widgets)
+    widgets[STATIONS] = ['O7094010', 'O8133520']
+    yield 'second station', dict(widgets)
+    widgets[FILTER] = True
+    yield 'filter on stations', dict(widgets)
+    widgets[FILTER] = False
+    yield 'no filter', dict(widgets)
+    widgets[VARIABLE] = QI
+    yield 'Qi', dict(widgets)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scale', type=int, default=1, help='rows of the flow CSVs, times the real ones')
+    args = parser.parse_args()
+
+    app = headless.load_app()
+    with headless.scaled_data(args.scale):
+        # Warm the process caches, then start a new page
+        headless.run_main(app, {STATIONS: ['O7094010']})
+        headless.new_session()
+        print(f'x{args.scale} data, times in ms, sizes in KB')
+        print(f'{"":<24}{"charts":>10}{"shown":>10}{"sent":>10}')
+        total_shown = total_sent = 0
+        for name, widgets in session():
+            run = headless.run_main(app, widgets)
+            total_shown += run.sent_bytes
+            total_sent += run.wire_bytes
+            print(f'{name:<24}{run.stages.get("charts", 0) * 1000:10.1f}{run.sent_bytes / 1024:10.1f}{run.wire_bytes / 1024:10.1f}')
+        print(f'{"session":<24}{"":>10}{total_shown / 1024:10.1f}{total_sent / 1024:10.1f}')
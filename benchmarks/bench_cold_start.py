@@ -0,0 +1,74 @@
+"""Cold start of the Qi/Qmj loaders: CSV parsing vs memory-mapped Feather cache.
+
+Every measurement runs in a fresh interpreter, like a dyno restart:
+  csv   the loader as it was, parsing the CSV on each start
+  build first start after a data drop, parsing the CSV and writing the cache
+  mmap  next starts, memory-mapping the cache
+
+    python -m benchmarks.bench_cold_start [--years 10]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+CHILD = """
+import sys, time
+import pandas as pd
+from datetime import datetime
+from time import mktime
+import pytz
+import utils
+
+def legacy_get_qi(filepath):
+    df = pd.read_csv(filepath, sep=',')
+    df['date'] = pd.to_datetime(df['date']).apply(lambda x: datetime.fromtimestamp(mktime(x.timetuple())))
+    df["date"] = df["date"].apply(pytz.UTC.localize)
+    df["date"] = df["date"].dt.tz_convert('Europe/Paris')
+    return df
+
+mode, filepath = sys.argv[1:3]
+start = time.perf_counter()
+if mode == 'csv':
+    df = legacy_get_qi(filepath)
+else:
+    df = utils.get_qi(filepath)
+utils.pivot_flows(df)
+print(time.perf_counter() - start)
+"""
+
+
+def measure(mode, filepath, cache_dir):
+    env = dict(os.environ, LVDLR_CACHE_DIR=cache_dir)
+    out = subprocess.run([sys.executable, '-c', CHILD, mode, filepath], env=env,
+                         stdout=subprocess.PIPE, check=True, universal_newlines=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def bench(filepath, cache_dir):
+    import utils
+    cache_path = os.path.join(cache_dir, os.path.basename(utils.flow_cache_path(filepath)))
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+    rows = sum(1 for _ in open(filepath)) - 1
+    results = {'csv': measure('csv', filepath, cache_dir), 'build': measure('build', filepath, cache_dir),
+               'mmap': measure('mmap', filepath, cache_dir)}
+    print(f"{os.path.basename(filepath):<28} {rows:>10} rows  " + '  '.join(f'{k} {v:7.2f}s' for k, v in results.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--years', type=float, default=10, help='span of the synthetic Qi file')
+    args = parser.parse_args()
+
+    from benchmarks.synthetic import make_qi_csv
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bench('data/hbv_qi.csv', tmp)
+        synthetic = os.path.join(tmp, f'qi_{args.years:g}y.csv')
+        start = time.perf_counter()
+        make_qi_csv(synthetic, years=args.years)
+        print(f'(generated {synthetic} in {time.perf_counter()-start:.1f}s)')
+        bench(synthetic, tmp)
@@ -0,0 +1,45 @@
+"""Threshold heatmap source: DataFrame.append loop vs stacking the status window.
+
+All stations are kept, as with a threshold every station is under. That
+both give the same rows is checked by tests/test_heatmap.py.
+
+    python -m benchmarks.bench_heatmap
+"""
+import time
+import warnings
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from utils import status_history
+
+STATIONS = 56
+DAY = pd.Timestamp('2020-08-15').date()
+
+
+def append_loop(status, stations, dates):
+    source = pd.DataFrame(columns=['stations', 'day', 'status'])
+    for station, row in zip(stations, status):
+        for i in range(0, len(dates)):
+            source = source.append({'stations': station, 'day': dates[i], 'status': row[i]}, ignore_index=True)
+    return source
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    # DataFrame.append is deprecated in recent pandas
+    warnings.simplefilter('ignore', FutureWarning)
+    rng = np.random.default_rng(0)
+    stations = [f'S{i:03d}' for i in range(STATIONS)]
+    for days in [7, 30, 90]:
+        status = rng.integers(0, 6, (STATIONS, days)).astype(np.int8)
+        dates = [DAY - timedelta(i) for i in range(days)]
+        old, t_old = timed(append_loop, status, stations, dates)
+        new, t_new = timed(status_history, status, stations, dates)
+        print(f'{days:>3} days x {STATIONS} stations  append loop {t_old:8.3f}s  stack {t_new:8.4f}s')
@@ -0,0 +1,71 @@
+"""Low-flow statistics over a long synthetic Qmj history, all stations at once.
+
+Reported: the full computation of LowFlowStats and its steps, the same
+indicators with pandas rolling/groupby on the wide frame, the update when one
+day or one month is added, and the frames read by the app views.
+
+    python -m benchmarks.bench_lowflow [--years 30] [--stations 50]
+"""
+import argparse
+import os
+import tempfile
+
+from benchmarks import headless
+
+headless.install()
+_cache_dir = tempfile.TemporaryDirectory(prefix='lvdlr-lowflow-')
+os.environ['LVDLR_CACHE_DIR'] = _cache_dir.name
+
+import pandas as pd  # noqa: E402
+
+import lowflow  # noqa: E402
+import utils  # noqa: E402
+from benchmarks.bench_utils import show, timed  # noqa: E402
+from benchmarks.synthetic import make_qmj_csv  # noqa: E402
+
+
+def pandas_indicators(matrix, thresholds):
+    # The same indicators with the pandas idioms, on the (days x stations) frame
+    days = pd.date_range(min(matrix.index), max(matrix.index), freq='D')
+    flows = matrix.reindex(index=days.date).astype(float).round(4)
+    flows.index = days
+    by_year = flows.index.year
+    result = {'jours mesurés': flows.notna().groupby(by_year).sum()}
+    for n in lowflow.VCN_DAYS:
+        result[f'VCN{n}'] = flows.rolling(n).mean().groupby(by_year).min()
+    monthly = flows.resample('M')
+    means = monthly.mean().where(monthly.count() >= lowflow.MONTH_COVERAGE * monthly.count().index.days_in_month.values[:, None])
+    result['QMNA'] = means.groupby(means.index.year).min()
+    for name, column in lowflow.THRESHOLDS.items():
+        result[f'jours sous {name}'] = flows.lt(thresholds[column].reindex(flows.columns), axis=1).groupby(by_year).sum()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--years', type=float, default=30)
+    parser.add_argument('--stations', type=int, default=50)
+    args = parser.parse_args()
+
+    path = make_qmj_csv(os.path.join(_cache_dir.name, 'hbv_qmj.csv'), years=args.years, stations=args.stations)
+    matrix = utils.FlowStore(path, daily=True).matrix
+    thresholds = utils.get_layer('data/stations.geojson').table.set_index('COD_STAT')
+    print(f'{args.years:g} years x {matrix.shape[1]} stations, {matrix.shape[0]} days')
+
+    show('LowFlowStats, all indicators', timed(lowflow.LowFlowStats, matrix, thresholds))
+    days, flows = lowflow.daily_flows(matrix)
+    show('  daily_flows', timed(lowflow.daily_flows, matrix))
+    for n in lowflow.VCN_DAYS:
+        show(f'  moving_average, {n} days', timed(lowflow.moving_average, flows, n))
+    stats = lowflow.LowFlowStats(matrix, thresholds)
+    show('  yearly_indicators', timed(lowflow.yearly_indicators, days, flows, stats.thresholds))
+    show('pandas rolling/resample/groupby, same indicators', timed(pandas_indicators, matrix, thresholds))
+
+    for name, added in [('one day', 1), ('one month', 30)]:
+        base = lowflow.LowFlowStats(matrix.iloc[:-added], thresholds)
+        show(f'appended, {name} added', timed(base.appended, matrix))
+
+    stations = list(matrix.columns)
+    show('frame, all stations', timed(stats.frame, stations))
+    show('days_below, one station and year', timed(stats.days_below, stations[:1], int(stats.years[-1])))
+    print(f'{stats.nbytes / 1024**2:.1f} MB kept')
@@ -0,0 +1,63 @@
+"""Full render pipeline: main() run headlessly over scripted widget states.
+
+For each scenario, the first run starts from empty process caches (cold) and
+the next ones are reruns (warm). Reported: wall time per stage marked with
+utils.stage(), total, peak memory traced on one warm run, and the bytes of
+charts sent.
+
+    python -m benchmarks.bench_main [--scale 10] [--repeat 3]
+"""
+import argparse
+from datetime import date
+
+import geopandas as gpd
+import pandas as pd
+
+from benchmarks import headless
+
+STATIONS = 'Sélectionnez une ou plusieurs stations'
+VARIABLE = 'Sélectionnez la variable à visualiser'
+QMJ, QI = 'Débit moyen journalier (Qmj)', 'Débit instantané (Qi)'
+STAGES = ['load', 'reshape', 'charts', 'status', 'colouring', 'map build']
+
+
+def scenarios(qmj_stations, qi_stations):
+    yield 'Qmj, 1 station', {STATIONS: qmj_stations[:1]}
+    yield 'Qmj, 5 stations', {STATIONS: qmj_stations[:5]}
+    yield 'Qmj, all stations', {STATIONS: qmj_stations}
+    yield 'Qi, 1 station', {VARIABLE: QI, STATIONS: qi_stations[:1]}
+    yield 'Qi, 5 stations', {VARIABLE: QI, STATIONS: qi_stations[:5]}
+    yield 'Qi, all stations', {VARIABLE: QI, STATIONS: qi_stations}
+    for day in [date(2019, 8, 15), date(2020, 8, 15)]:
+        for threshold in ['DOE', 'DA', 'DAR', 'DC']:
+            yield f'Qmj, {day}, {threshold}', {STATIONS: qmj_stations[:1], 'Choisir une date': day, 'Choisir un seuil': threshold}
+
+
+def report(name, runs, peak):
+    stages = {stage: sum(run.stages.get(stage, 0) for run in runs) / len(runs) for stage in STAGES}
+    total = sum(run.total for run in runs) / len(runs)
+    print(f'{name:<28}' + ''.join(f'{stages[stage] * 1000:10.1f}' for stage in STAGES)
+          + f'{total * 1000:10.1f}{peak / 1024**2:10.1f}{runs[-1].sent_bytes / 1024:10.1f}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scale', type=int, default=1, help='rows of the flow CSVs, times the real ones')
+    parser.add_argument('--repeat', type=int, default=3, help='warm runs per scenario')
+    args = parser.parse_args()
+
+    app = headless.load_app()
+
+    with headless.scaled_data(args.scale):
+        # Only stations of stations.geojson: the Qmj of the day can't be shown for the others
+        known = set(gpd.read_file('data/stations.geojson')['COD_STAT'])
+        qmj_stations, qi_stations = ([s for s in pd.read_csv(f'data/hbv_{kind}.csv', usecols=['code_station'])['code_station'].unique() if s in known] for kind in ['qmj', 'qi'])
+        print(f'x{args.scale} data, times in ms, peak in MB, sent in KB')
+        print(f'{"":<28}' + ''.join(f'{stage:>10}' for stage in STAGES) + f'{"total":>10}{"peak":>10}{"sent":>10}')
+
+        cold = headless.run_main(app, {STATIONS: qmj_stations[:1]}, trace_memory=True)
+        report('first run (cold)', [cold], cold.peak)
+        for name, widgets in scenarios(qmj_stations, qi_stations):
+            runs = [headless.run_main(app, widgets) for _ in range(args.repeat)]
+            peak = headless.run_main(app, widgets, trace_memory=True).peak
+            report(name, runs, peak)
@@ -0,0 +1,44 @@
+"""Map payload per rerun: full geometries vs the level of detail for the zoom,
+with all the attributes of the features or only their colour.
+
+The pydeck spec is serialized like pydeck 0.5 does (compact json.dumps) and
+Streamlit sends all of it on every rerun.
+
+    python -m benchmarks.bench_map_payload
+"""
+import json
+import time
+
+import numpy as np
+
+from utils import get_layer
+
+LAYERS = ['data/ss-unites-gestion.geojson', 'data/hydrographie.geojson']
+ZOOMS = [6, 7, 8, 9, 10, 11, 12, 13]
+COLOR = [0, 0, 255, 200]
+
+
+def payload(zoom, colors_only=False):
+    data = []
+    for filepath in LAYERS:
+        layer = get_layer(filepath)
+        if colors_only:
+            data.append(layer.colored(zoom=zoom, color=np.tile(np.array(COLOR, dtype=np.uint8), (len(layer.table), 1))))
+        else:
+            frame = layer.frame()
+            frame['color'] = [COLOR] * len(frame)
+            data.append(layer.to_pydeck(frame, zoom=zoom))
+    start = time.perf_counter()
+    size = len(json.dumps(data, sort_keys=True))
+    return size, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    full, t_full = payload(None)
+    print(f'full geometries  {full / 1e6:6.3f} MB  json {t_full * 1000:6.1f} ms')
+    for zoom in ZOOMS:
+        level = get_layer(LAYERS[1]).level_for(zoom)
+        for colors_only in [False, True]:
+            size, t = payload(zoom, colors_only)
+            kind = 'colours' if colors_only else 'attributes'
+            print(f'zoom {zoom:>2} (level {level}) {kind:<10}  {size / 1e6:6.3f} MB  json {t * 1000:6.1f} ms  {full / size:5.1f}x smaller')
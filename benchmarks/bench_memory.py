@@ -0,0 +1,59 @@
+"""Memory of the datasets: what each process keeps, and what each session run allocates.
+
+Per process: bytes held by each flow store (rows, StationIndex, matrix,
+pyramid), by the layers and by the shared states, and the RSS after a cold
+run. Per session: peak of the memory allocated by one warm run of main(),
+traced with tracemalloc, i.e. what every concurrent rerun adds on top.
+
+    python -m benchmarks.bench_memory [--scale 10]
+"""
+import argparse
+
+import geopandas as gpd
+import pandas as pd
+
+from benchmarks import headless
+from benchmarks.bench_main import QI, STATIONS, VARIABLE
+
+MB = 1024**2
+
+
+def process_report(utils):
+    for name, kwargs in [('qmj', dict(daily=True)), ('qi', dict(tz='Europe/Paris'))]:
+        store = utils.get_store(f'data/hbv_{name}.csv', **kwargs)
+        # The rows are those of the StationIndex, counted once in the total
+        parts = {'rows': store.data, 'index with the rows': store.index, 'matrix': store._matrix, 'pyramid': store._pyramid}
+        sizes = {part: utils._nbytes(value) / MB for part, value in parts.items() if value is not None}
+        print(f'  {name} store, {len(store.data)} rows: ' + ', '.join(f'{part} {size:.2f}' for part, size in sizes.items())
+              + f', total {store.nbytes / MB:.2f} MB')
+        print(f'    dtypes: ' + ', '.join(f'{column} {dtype}' for column, dtype in store.data.dtypes.items()))
+    for name, stats in utils.cache_stats().items():
+        print(f'  {name} cache: {stats["nbytes"] / MB:.2f} MB in {stats["entries"]} entries')
+    print(f'  RSS {utils._rss() / MB:.1f} MB')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scale', type=int, default=1, help='rows of the flow CSVs, times the real ones')
+    args = parser.parse_args()
+
+    app = headless.load_app()
+    import utils
+
+    with headless.scaled_data(args.scale):
+        known = set(gpd.read_file('data/stations.geojson')['COD_STAT'])
+        qmj_stations, qi_stations = ([s for s in pd.read_csv(f'data/hbv_{kind}.csv', usecols=['code_station'])['code_station'].unique() if s in known] for kind in ['qmj', 'qi'])
+        scenarios = [
+            ('Qmj, 1 station', {STATIONS: qmj_stations[:1]}),
+            ('Qmj, all stations', {STATIONS: qmj_stations}),
+            ('Qi, 1 station', {VARIABLE: QI, STATIONS: qi_stations[:1]}),
+            ('Qi, all stations', {VARIABLE: QI, STATIONS: qi_stations}),
+        ]
+        for _, widgets in scenarios:
+            headless.run_main(app, widgets)
+
+        print(f'x{args.scale} data, per process')
+        process_report(utils)
+        print('per session, peak allocated by a warm run')
+        for name, widgets in scenarios:
+            print(f'  {name:<20}{headless.run_main(app, widgets, trace_memory=True).peak / MB:8.2f} MB')
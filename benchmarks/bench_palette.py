@@ -0,0 +1,38 @@
+"""Status colours: get_status_color per feature vs one lookup in STATUS_PALETTE.
+
+Times the colouring of the hydrographie layer for one day and for the
+whole Qmj history. That the table gives the colours of get_status_color is
+checked by tests/test_palette.py.
+
+    python -m benchmarks.bench_palette
+"""
+import time
+
+from utils import THRESHOLDS, get_layer, get_qmj, get_status_color, get_status_cube, load_qmj, status_colors
+
+REPEAT = 200
+
+
+def legacy(status, t):
+    return [get_status_color(x, t) for x in status]
+
+
+def timed(func, *args, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(*args)
+    return (time.perf_counter() - start) / repeat
+
+
+if __name__ == "__main__":
+    stations = get_layer('data/stations.geojson')
+    hydro = get_layer('data/hydrographie.geojson')
+    ug = get_layer('data/ss-unites-gestion.geojson')
+    codes = sorted(get_qmj('data/hbv_qmj.csv')['code_station'].unique())
+    cube = get_status_cube(load_qmj('data/hbv_qmj.csv'), stations, hydro, ug, list(THRESHOLDS.values()), codes)
+    day = cube.levels[1][-1]
+    t_old, t_new = timed(legacy, day, 'hydro', repeat=REPEAT), timed(status_colors, day, 'hydro', repeat=REPEAT)
+    print(f'hydrographie, one day ({len(day)} reaches)  legacy {t_old * 1e6:8.1f} us  palette {t_new * 1e6:8.1f} us')
+    history = cube.levels[1]
+    t_old, t_new = timed(legacy, history.ravel(), 'hydro'), timed(status_colors, history, 'hydro')
+    print(f'hydrographie, whole history ({history.size} reach-days)  legacy {t_old * 1e3:8.1f} ms  palette {t_new * 1e3:8.2f} ms')
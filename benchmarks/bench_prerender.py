@@ -0,0 +1,59 @@
+"""Pre-rendering of the daily basin snapshots: throughput of the batch, and past dates in the app.
+
+Reported: days per second of prerender.py with one process and with one per
+core, a resumed run with nothing left to render, the size of the store, and
+the time of a run of main() on a past date not yet in the state cache, with
+and without its snapshot.
+
+    python -m benchmarks.bench_prerender [--days 62]
+"""
+import argparse
+import os
+import tempfile
+from datetime import timedelta
+
+from benchmarks import headless
+
+headless.install()
+_snapshot_dir = tempfile.TemporaryDirectory(prefix='lvdlr-snapshots-')
+os.environ['LVDLR_SNAPSHOT_DIR'] = _snapshot_dir.name
+
+import prerender  # noqa: E402
+import snapshots  # noqa: E402
+import utils  # noqa: E402
+from benchmarks.bench_main import STATIONS  # noqa: E402
+
+
+def store_size():
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(_snapshot_dir.name) for name in names)
+
+
+def past_dates(app, days, with_snapshots):
+    # A run per day, each on a day the state cache doesn't have yet
+    snapshots.SNAPSHOT_DIR = _snapshot_dir.name if with_snapshots else os.path.join(_snapshot_dir.name, 'none')
+    utils.drain_states()
+    runs = [headless.run_main(app, {STATIONS: ['O7094010'], 'Choisir une date': day}) for day in days]
+    return sum(run.total for run in runs) / len(runs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=int, default=62, help='days to render, up to the last one of the Qmj')
+    args = parser.parse_args()
+
+    app = headless.load_app()
+    headless.run_main(app, {STATIONS: ['O7094010']})
+    last = prerender.status_cube_of(utils.load_sources()).days[-1]
+    start = last - timedelta(args.days - 1)
+
+    cores = os.cpu_count() or 1
+    for processes in sorted({1, cores}):
+        days, size, seconds = prerender.prerender(start, last, processes, force=True)
+        print(f'{processes} process(es): {days} days in {seconds:.1f} s, {days / seconds:.2f} days/s')
+    days, _, seconds = prerender.prerender(start, last)
+    print(f'resumed run: {days} days rendered in {seconds:.3f} s')
+    print(f'store: {store_size() / 1024:.0f} KB, {store_size() / 1024 / args.days:.1f} KB per day')
+
+    days = [last - timedelta(d) for d in range(1, min(args.days, 10))]
+    print(f'main() on a past date, computed:      {past_dates(app, days, False) * 1000:8.1f} ms')
+    print(f'main() on a past date, from snapshot: {past_dates(app, days, True) * 1000:8.1f} ms')
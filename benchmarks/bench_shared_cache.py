@@ -0,0 +1,63 @@
+"""Load test of the shared basin state: concurrent sessions vs each computing its own.
+
+Every simulated session asks for the basin and threshold states of one of a
+few dates at the same time, like staff opening the app together. With the
+shared cache, each distinct key must be computed once.
+
+    python -m benchmarks.bench_shared_cache
+"""
+import threading
+import time
+from datetime import date, timedelta
+
+import utils
+from utils import (THRESHOLDS, SharedCache, basin_state, get_basin_state, get_layer, get_qmj, get_qmj_matrix,
+                   get_status_cube, get_threshold_state, load_qmj, threshold_state)
+
+QMJ = 'data/hbv_qmj.csv'
+LAST_DAY = date(2020, 10, 30)
+
+
+def session(context, day, shared):
+    stations_layer, qmj_matrix, cube, stations = context
+    if shared:
+        _, map_stations, _, _ = get_basin_state(stations_layer, qmj_matrix, cube, stations, day)
+        get_threshold_state(map_stations, cube, day, 'DOE', THRESHOLDS['DOE'], 2, 30)
+    else:
+        _, map_stations, _, _ = basin_state(stations_layer, qmj_matrix, cube, stations, day)
+        threshold_state(map_stations, cube, day, 'DOE', THRESHOLDS['DOE'], 2, 30)
+
+
+def run(context, sessions, dates, shared):
+    utils._state_cache = SharedCache(utils.STATE_CACHE_MAX_BYTES)
+    barrier = threading.Barrier(sessions)
+
+    def target(i):
+        barrier.wait()
+        session(context, dates[i % len(dates)], shared)
+
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, utils._state_cache.stats()
+
+
+if __name__ == "__main__":
+    stations_layer = get_layer('data/stations.geojson')
+    hydro_layer = get_layer('data/hydrographie.geojson')
+    ug_layer = get_layer('data/ss-unites-gestion.geojson')
+    stations = sorted(get_qmj(QMJ)['code_station'].unique())
+    cube = get_status_cube(load_qmj(QMJ), stations_layer, hydro_layer, ug_layer, list(THRESHOLDS.values()), stations)
+    context = (stations_layer, get_qmj_matrix(QMJ), cube, stations)
+
+    for sessions, n_dates in [(8, 1), (32, 1), (32, 4), (64, 8)]:
+        dates = [LAST_DAY - timedelta(d) for d in range(n_dates)]
+        t_alone, _ = run(context, sessions, dates, shared=False)
+        t_shared, stats = run(context, sessions, dates, shared=True)
+        # One basin and one threshold state per date
+        assert stats['misses'] == 2 * n_dates, stats
+        print(f'{sessions:>3} sessions, {n_dates} dates  unshared {t_alone:6.3f}s  shared {t_shared:6.3f}s  '
+              f'computed {stats["misses"]}, waited {stats["waits"]}, hits {stats["hits"]}')
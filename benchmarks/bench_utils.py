@@ -0,0 +1,93 @@
+"""Microbenchmarks of the utils.py functions, next to what replaced them in the app.
+
+    python -m benchmarks.bench_utils [--scale 10]
+"""
+import argparse
+import time
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import headless
+
+headless.install()
+import utils  # noqa: E402
+
+THRESHOLD_COLUMNS = list(utils.THRESHOLDS.values())
+DAY = date(2020, 8, 15)
+
+
+def timed(func, *args, min_time=0.2):
+    """Mean time of func(*args) after a first untimed call, repeated for at least min_time seconds"""
+    func(*args)
+    calls, start = 0, time.perf_counter()
+    while True:
+        func(*args)
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / calls
+
+
+def show(name, seconds):
+    unit, factor = ('ms', 1e3) if seconds >= 1e-3 else ('us', 1e6)
+    print(f'{name:<58}{seconds * factor:10.1f} {unit}')
+
+
+def loaders():
+    show('get_qmj, cold (FlowStore from the Feather cache)', timed(utils.FlowStore, 'data/hbv_qmj.csv', None, True))
+    show('get_qmj, warm', timed(utils.get_qmj, 'data/hbv_qmj.csv'))
+    show('get_qi, cold (FlowStore from the Feather cache)', timed(utils.FlowStore, 'data/hbv_qi.csv', 'Europe/Paris'))
+    show('get_qi, warm', timed(utils.get_qi, 'data/hbv_qi.csv'))
+
+
+def reshape(data):
+    stations = data['code_station'].unique()
+    show(f'process_stations, all {len(stations)} stations + concat',
+         timed(lambda: pd.concat([utils.process_stations(s, data) for s in stations], axis=1)))
+    show('  pivot_flows', timed(utils.pivot_flows, data))
+
+
+def status(layers, flows):
+    stations, hydro, ug = (layer.table for layer in layers)
+    thresholds = stations[THRESHOLD_COLUMNS].to_numpy(dtype=float)
+    show(f'get_station_status, {len(stations)} stations',
+         timed(lambda: [utils.get_station_status(q, *t) for q, t in zip(flows, thresholds)]))
+    show('  classify_flows', timed(utils.classify_flows, flows[:, None], thresholds))
+
+    station_status = pd.Series(utils.classify_flows(flows[:, None], thresholds)[:, 0], index=stations.index)
+    show(f'get_hydro_status, {len(hydro)} reaches',
+         timed(lambda: [utils.get_hydro_status(i, station_status, stations['ID_hydrographie']) for i in hydro['ID_hydrographie']]))
+    hydro_status = pd.Series([utils.get_hydro_status(i, station_status, stations['ID_hydrographie']) for i in hydro['ID_hydrographie']])
+    show(f'get_ug_status, {len(ug)} units',
+         timed(lambda: [utils.get_ug_status(i, hydro_status, hydro['ID_ss-unite-gestion']) for i in ug['ID_ss-unite-gestion']]))
+    topology = utils.get_topology(*layers)
+    show('  TopologyIndex.roll_up, reaches and units', timed(topology.roll_up, station_status.to_numpy()))
+
+
+def rivers(layers, map_stations):
+    show('process_rivers, every river + concat',
+         timed(lambda: pd.concat([utils.process_rivers(r, map_stations, utils.RIVERS) for r in utils.RIVERS], ignore_index=True, sort=False)))
+    show('  TopologyIndex.rivers_frame', timed(utils.get_topology(*layers).rivers_frame, map_stations))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scale', type=int, default=1, help='rows of the flow CSVs, times the real ones')
+    args = parser.parse_args()
+
+    with headless.scaled_data(args.scale):
+        print(f'x{args.scale} data')
+        loaders()
+        reshape(utils.get_qmj('data/hbv_qmj.csv'))
+
+        layers = [utils.get_layer(f'data/{name}.geojson') for name in ['stations', 'hydrographie', 'ss-unites-gestion']]
+        matrix = utils.get_qmj_matrix('data/hbv_qmj.csv')
+        flows = matrix.reindex(index=[DAY], columns=layers[0].table['COD_STAT']).to_numpy(dtype=float)[0]
+        status(layers, np.round(flows, 4))
+
+        stations = list(matrix.columns)
+        cube = utils.get_status_cube(utils.load_qmj('data/hbv_qmj.csv'), *layers, THRESHOLD_COLUMNS, stations)
+        _, map_stations, _, _ = utils.basin_state(layers[0], matrix, cube, stations, DAY)
+        rivers(layers, map_stations)
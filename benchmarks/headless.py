@@ -0,0 +1,230 @@
+"""Headless runs of app.main() with a stand-in streamlit module and scripted widget states.
+
+Widgets return the value scripted for their label, else their default.
+Charts are serialized when they are sent, like Streamlit does, so that their
+cost is part of the run and their size can be reported. Like Streamlit, a
+chart of at least global.minCachedMessageSize bytes (.streamlit/config.toml)
+already sent in one of the last two runs of the session goes as a reference
+to the browser's copy (new_session() empties it).
+
+    from benchmarks import headless
+    app = headless.load_app()
+    run = headless.run_main(app, {'Sélectionnez une ou plusieurs stations': ['O7094010']})
+"""
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import pandas as pd
+import toml
+
+from benchmarks.synthetic import make_qi_csv, make_qmj_csv
+
+LAYERS = ['hydrographie.geojson', 'ss-unites-gestion.geojson', 'stations.geojson']
+# global.minCachedMessageSize and global.maxCachedMessageAge of Streamlit, as configured for the app
+_config = toml.load(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.streamlit', 'config.toml'))
+MIN_CACHED_MESSAGE_SIZE = _config['global'].get('minCachedMessageSize', 10 * 1000)
+MAX_CACHED_MESSAGE_AGE = _config['global'].get('maxCachedMessageAge', 2)
+
+
+class StopRun(Exception):
+    """Raised by st.stop(), like Streamlit does to end the script run"""
+
+
+class Run:
+    """Outcome of one run of main(): stage timings, total, peak memory and what was sent"""
+
+    def __init__(self):
+        self.stages = {}
+        self.total = 0
+        self.peak = None
+        self.outputs = []
+        self.wire = []
+        self.stopped = False
+
+    @property
+    def sent_bytes(self):
+        return sum(size for _, size in self.outputs)
+
+    @property
+    def wire_bytes(self):
+        """Bytes of the charts sent in full, the others being references to the browser's copy"""
+        return sum(size for _, size in self.wire)
+
+
+_widgets = {}
+_query = {}
+_run = Run()
+_datasets = {}
+# Hash of the chart messages the browser has, and the number of the run that last sent them
+_browser = {}
+_run_number = 0
+
+
+def _widget(kind):
+    def widget(label, *args, **kwargs):
+        if label in _widgets:
+            return _widgets[label]
+        options = kwargs.get('options', args[0] if args else None)
+        if kind in ('radio', 'selectbox'):
+            return list(options)[kwargs.get('index', 0)]
+        if kind == 'multiselect':
+            return list(kwargs.get('default') or [])
+        if kind == 'checkbox':
+            return kwargs.get('value', False)
+        if kind == 'button':
+            return False
+        return kwargs.get('value')
+    return widget
+
+
+def _send(kind, size, content):
+    _run.outputs.append((kind, size))
+    digest = hashlib.sha1(content.encode()).hexdigest()
+    cached = size >= MIN_CACHED_MESSAGE_SIZE and _run_number - _browser.get(digest, -MAX_CACHED_MESSAGE_AGE - 1) <= MAX_CACHED_MESSAGE_AGE
+    _run.wire.append((kind, 0 if cached else size))
+    _browser[digest] = _run_number
+
+
+def new_session():
+    """Forget the messages the browser has, as for a new page"""
+    _browser.clear()
+
+
+def _store_dataset(data):
+    name = f'data-{id(data)}'
+    _datasets[name] = data
+    return {'name': name}
+
+
+def _altair_chart(chart, **kwargs):
+    # Datasets are sent apart from the spec, as Streamlit does
+    import altair as alt
+    _datasets.clear()
+    with alt.data_transformers.enable('headless'):
+        spec = json.dumps(chart.to_dict())
+    _send_vega_lite(spec, _datasets)
+
+
+def _vega_lite_chart(spec, **kwargs):
+    spec = dict(spec)
+    datasets = spec.pop('datasets', {})
+    _send_vega_lite(json.dumps(spec), datasets)
+
+
+def _send_vega_lite(spec, datasets):
+    # Datasets go apart from the spec, with their names
+    data = [name + data.to_json(orient='records', date_format='iso', default_handler=str) for name, data in datasets.items()]
+    _send('altair', len(spec) + sum(len(x) for x in data), spec + ''.join(data))
+
+
+def _pydeck_chart(deck, **kwargs):
+    # pydeck 0.5 serializes the deck in compact JSON
+    spec = json.dumps(json.loads(deck.to_json()))
+    _send('deck', len(spec), spec)
+
+
+def _text(*args, **kwargs):
+    _run.outputs.append(('text', len(str(args[0])) if args else 0))
+
+
+def _stop():
+    raise StopRun()
+
+
+def install():
+    """Register the stand-in streamlit module, before app or utils are imported"""
+    if getattr(sys.modules.get('streamlit'), 'headless', False):
+        return sys.modules['streamlit']
+    import altair as alt
+    alt.data_transformers.register('headless', _store_dataset)
+
+    st = types.ModuleType('streamlit')
+    st.headless = True
+    st.cache = lambda func=None, **kwargs: func if func is not None else (lambda f: f)
+    st.beta_set_page_config = lambda **kwargs: None
+    st.beta_columns = lambda spec: [contextlib.nullcontext() for _ in spec]
+    st.beta_expander = lambda *args, **kwargs: contextlib.nullcontext()
+    st.spinner = lambda *args, **kwargs: contextlib.nullcontext()
+    st.sidebar = st
+    st.experimental_get_query_params = lambda: dict(_query)
+    st.stop = _stop
+    st.empty = lambda: st
+    for kind in ['radio', 'multiselect', 'slider', 'select_slider', 'date_input', 'checkbox', 'selectbox', 'number_input', 'button']:
+        setattr(st, kind, _widget(kind))
+    for kind in ['markdown', 'write', 'subheader', 'header', 'title', 'caption', 'text', 'warning', 'error', 'info', 'json', 'dataframe', 'table', 'code', 'bokeh_chart']:
+        setattr(st, kind, _text)
+    st.altair_chart = _altair_chart
+    st.vega_lite_chart = _vega_lite_chart
+    st.pydeck_chart = _pydeck_chart
+    sys.modules['streamlit'] = st
+    return st
+
+
+def load_app():
+    install()
+    import app
+    return app
+
+
+def run_main(app, widgets=None, query=None, trace_memory=False):
+    """Run app.main() once with the given widget values (by label) and query parameters"""
+    global _run, _run_number
+    import utils
+    _widgets.clear()
+    _widgets.update(widgets or {})
+    _query.clear()
+    _query.update(query or {})
+    _run = run = Run()
+    _run_number += 1
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with utils.record_stages() as timer:
+        try:
+            app.main()
+        except StopRun:
+            run.stopped = True
+    run.total = time.perf_counter() - start
+    if trace_memory:
+        run.peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    run.stages = dict(timer.stages)
+    return run
+
+
+@contextlib.contextmanager
+def scaled_data(factor):
+    """Work in a temporary copy of data/ whose flow CSVs have factor times as many rows.
+
+    The synthetic histories end on the same day as the real ones and keep their
+    stations, so the default widget values of the app still apply.
+    """
+    if factor == 1:
+        yield os.getcwd()
+        return
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix=f'lvdlr-x{factor}-')
+    try:
+        os.makedirs(os.path.join(directory, 'data'))
+        for name in LAYERS:
+            shutil.copy(os.path.join('data', name), os.path.join(directory, 'data', name))
+        for kind, make in [('qmj', make_qmj_csv), ('qi', make_qi_csv)]:
+            source = pd.read_csv(os.path.join('data', f'hbv_{kind}.csv'))
+            stations = source['code_station'].nunique()
+            per_year = 365.25 if kind == 'qmj' else 365.25 * 96
+            make(os.path.join(directory, 'data', f'hbv_{kind}.csv'), years=factor * len(source) / (stations * per_year),
+                 stations=stations, end=source['date'].max())
+        os.chdir(directory)
+        yield directory
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
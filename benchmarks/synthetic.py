@@ -0,0 +1,60 @@
+"""Synthetic flow CSVs shaped like data/hbv_qmj.csv and data/hbv_qi.csv"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+
+def synthetic_flows(stations, dates, seed=0):
+    """Long (code_station, date, debit) frame with a seasonal low-flow pattern"""
+    rng = np.random.default_rng(seed)
+    n = len(dates)
+    day_of_year = np.asarray(dates.dayofyear, dtype=float)
+    season = 1 + 0.8 * np.cos(2 * np.pi * (day_of_year - 30) / 365.25)
+    frames = []
+    for station in stations:
+        scale = rng.lognormal(0, 1.5)
+        noise = rng.lognormal(0, 0.3, n)
+        frames.append(pd.DataFrame({
+            'code_station': station,
+            'date': dates,
+            'debit': (scale * season * noise).round(6),
+        }))
+    return pd.concat(frames, ignore_index=True).sort_values('date', kind='mergesort')
+
+
+def station_codes(filepath, n):
+    # Reuse real codes first so that stations.geojson thresholds still apply
+    codes = list(pd.read_csv(filepath, usecols=['code_station'])['code_station'].unique())
+    codes += [f'SYN{i:05d}' for i in range(n - len(codes))]
+    return codes[:n]
+
+
+def make_qmj_csv(path, years=2, stations=50, end='2020-10-14'):
+    dates = pd.date_range(end=end, periods=int(years*365.25), freq='D')
+    df = synthetic_flows(station_codes('data/hbv_qmj.csv', stations), dates)
+    df['date'] = df['date'].dt.strftime('%Y-%m-%d')
+    df.to_csv(path, index=False)
+    return path
+
+
+def make_qi_csv(path, years=1, stations=15, end='2020-10-14 23:45:00'):
+    dates = pd.date_range(end=end, periods=int(years*365.25*96), freq='15min')
+    df = synthetic_flows(station_codes('data/hbv_qi.csv', stations), dates)
+    df['date'] = df['date'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    df.to_csv(path, index=False)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('kind', choices=['qmj', 'qi'])
+    parser.add_argument('path')
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument('--stations', type=int)
+    args = parser.parse_args()
+    make = make_qmj_csv if args.kind == 'qmj' else make_qi_csv
+    kwargs = {'years': args.years}
+    if args.stations:
+        kwargs['stations'] = args.stations
+    make(args.path, **kwargs)
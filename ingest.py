@@ -0,0 +1,26 @@
+"""Build the columnar caches of the flow CSVs.
+
+Run at build time (see bin/post_compile) so that the web dyno memory-maps the
+Feather files on cold start instead of parsing the CSVs. The loaders rebuild a
+cache by themselves when its CSV changes, so running this is optional.
+"""
+import sys
+import time
+
+from utils import build_flow_cache, flow_cache_is_fresh, flow_cache_path
+
+FLOW_FILES = ['data/hbv_qmj.csv', 'data/hbv_qi.csv']
+
+
+def main(filepaths):
+    for filepath in filepaths:
+        if flow_cache_is_fresh(filepath):
+            print(f'{filepath}: {flow_cache_path(filepath)} is up to date')
+            continue
+        start = time.perf_counter()
+        cache_path = build_flow_cache(filepath)
+        print(f'{filepath}: built {cache_path} in {time.perf_counter()-start:.2f}s')
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or FLOW_FILES)
@@ -0,0 +1,191 @@
+"""Low-flow statistics of the Qmj history, for all stations at once.
+
+Indicators per station and calendar year:
+  VCN3, VCN10  lowest mean Qmj over 3 (10) consecutive days
+  QMNA         lowest monthly mean Qmj
+  sous DOE...  number of days with a Qmj under each threshold of stations.geojson
+
+They are computed on the (days x stations) Qmj array: moving averages from
+cumulative sums, and reductions over the contiguous rows of each month and
+year, so there is no loop over stations nor days.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from utils import THRESHOLDS
+
+# Lengths in days of the moving averages of the VCN
+VCN_DAYS = (3, 10)
+# Share of the days of a month that must have a Qmj for its mean to count in the QMNA
+MONTH_COVERAGE = 0.8
+INDICATORS = ['jours mesurés'] + [f'VCN{n}' for n in VCN_DAYS] + ['QMNA'] + [f'jours sous {t}' for t in THRESHOLDS]
+
+
+def daily_flows(matrix):
+    """Every day from the first to the last of the Qmj matrix, and the (days x stations) float64 Qmj, NaN where missing"""
+    days = pd.date_range(min(matrix.index), max(matrix.index), freq='D')
+    # Rounded like the Qmj displayed on the map, as the status cube
+    return days, np.round(matrix.reindex(index=days.date).to_numpy(dtype=float), 4)
+
+
+def moving_average(flows, n):
+    """n-day moving average of each column, NaN when one of the n days is missing and for the first n-1 days"""
+    valid = ~np.isnan(flows)
+    sums = np.cumsum(np.vstack([np.zeros((1, flows.shape[1])), np.where(valid, flows, 0)]), axis=0)
+    counts = np.cumsum(np.vstack([np.zeros((1, flows.shape[1]), dtype=np.int64), valid]), axis=0)
+    average = np.full(flows.shape, np.nan)
+    full = counts[n:] - counts[:-n] == n
+    average[n-1:] = np.where(full, (sums[n:] - sums[:-n]) / n, np.nan)
+    return average
+
+
+def _starts(keys):
+    # First row of each run of equal keys, e.g. of each year of sorted days
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+
+def _lowest(values, starts):
+    # Minimum of each period, ignoring NaN; NaN for the periods without values
+    with np.errstate(invalid='ignore'):
+        return np.fmin.reduceat(values, starts, axis=0)
+
+
+def yearly_indicators(days, flows, thresholds, first_year=None):
+    """Indicators of the years from first_year on (of all years if None).
+
+    thresholds is a (thresholds x stations) array in the order of THRESHOLDS.
+    Returns the years and, per name of INDICATORS, a (years x stations) array.
+    """
+    years = days.year.values
+    start = 0 if first_year is None else np.searchsorted(years, first_year)
+    # Windows of the VCN of the first days of the first year begin in the year before
+    lead = max(0, start - (max(VCN_DAYS) - 1))
+    averages = {n: moving_average(flows[lead:], n)[start-lead:] for n in VCN_DAYS}
+    days, flows, years = days[start:], flows[start:], years[start:]
+    year_starts = _starts(years)
+    valid = ~np.isnan(flows)
+
+    values = OrderedDict()
+    values['jours mesurés'] = np.add.reduceat(valid, year_starts, axis=0).astype(float)
+    for n in VCN_DAYS:
+        values[f'VCN{n}'] = _lowest(averages[n], year_starts)
+
+    months = years * 12 + days.month.values
+    month_starts = _starts(months)
+    month_counts = np.add.reduceat(valid, month_starts, axis=0)
+    month_means = np.add.reduceat(np.where(valid, flows, 0), month_starts, axis=0) / np.maximum(month_counts, 1)
+    month_means[month_counts < MONTH_COVERAGE * days[month_starts].days_in_month.values[:, None]] = np.nan
+    values['QMNA'] = _lowest(month_means, _starts(years[month_starts]))
+
+    with np.errstate(invalid='ignore'):
+        for name, threshold in zip(THRESHOLDS, thresholds):
+            below = np.add.reduceat(flows < threshold, year_starts, axis=0).astype(float)
+            below[:, np.isnan(threshold)] = np.nan
+            values[f'jours sous {name}'] = below
+    return years[year_starts], values
+
+
+class LowFlowStats:
+    """Low-flow indicators of every station and year of the Qmj history.
+
+    Arrays are (years x stations) and follow the columns of the Qmj matrix.
+    When days are added, only the years from the first changed day on are
+    computed again (appended). threshold_table holds the threshold columns
+    of the stations, indexed by code. version is the one of the store the
+    matrix comes from.
+    """
+
+    def __init__(self, matrix, threshold_table, version=None, days=None, flows=None, years=None, values=None):
+        self.version = version
+        self.stations = matrix.columns
+        self.threshold_table = threshold_table
+        self.thresholds = threshold_table.reindex(index=self.stations, columns=list(THRESHOLDS.values())).to_numpy(dtype=float).T
+        if days is None:
+            days, flows = daily_flows(matrix)
+            years, values = yearly_indicators(days, flows, self.thresholds)
+        self.days, self.flows = days, flows
+        self.years, self.values = years, values
+
+    @property
+    def nbytes(self):
+        return self.flows.nbytes + sum(x.nbytes for x in self.values.values())
+
+    def appended(self, matrix, version=None):
+        """Indicators of matrix, the Qmj matrix with new days, recomputing the years they fall in"""
+        days, flows = daily_flows(matrix)
+        old = len(self.days)
+        if not matrix.columns.equals(self.stations) or days[0] != self.days[0] or len(days) < old:
+            return LowFlowStats(matrix, self.threshold_table, version)
+
+        same = (flows[:old] == self.flows) | (np.isnan(flows[:old]) & np.isnan(self.flows))
+        changed = np.flatnonzero(~same.all(axis=1))
+        first = changed[0] if len(changed) else old
+        if first == len(days):
+            return LowFlowStats(matrix, self.threshold_table, version, days, flows, self.years, self.values)
+
+        first_year = days[first].year
+        years, values = yearly_indicators(days, flows, self.thresholds, first_year)
+        kept = self.years < first_year
+        values = OrderedDict((name, np.vstack([self.values[name][kept], values[name]])) for name in INDICATORS)
+        return LowFlowStats(matrix, self.threshold_table, version, days, flows, np.r_[self.years[kept], years], values)
+
+    def frame(self, stations):
+        """Long (station, year) table of the indicators of stations"""
+        at = self.stations.get_indexer(stations)
+        at = at[at >= 0]
+        frame = pd.DataFrame({
+            'station': np.repeat(self.stations[at], len(self.years)),
+            'année': np.tile(self.years, len(at)),
+        })
+        for name in INDICATORS:
+            frame[name] = self.values[name][:, at].T.ravel()
+        return frame
+
+    def days_below(self, stations, year, until=None):
+        """Long (station, day, seuil, jours) frame of the days under each threshold since the start of year.
+
+        Only the first and last days and those where a count changes are kept,
+        which is all a step chart needs. Stations without thresholds have no rows.
+        """
+        at = self.stations.get_indexer(stations)
+        at = at[at >= 0]
+        rows = np.flatnonzero((self.days.year == year) & (self.days <= pd.Timestamp(until or self.days[-1])))
+        flows = self.flows[rows][:, at]
+        frames = []
+        with np.errstate(invalid='ignore'):
+            for name, threshold in zip(THRESHOLDS, self.thresholds[:, at]):
+                counts = np.cumsum(flows < threshold, axis=0).astype(float)
+                counts[:, np.isnan(threshold)] = np.nan
+                keep = ~np.isnan(counts)
+                keep[1:-1] &= counts[1:-1] != counts[:-2]
+                station, day = np.nonzero(keep.T)
+                frames.append(pd.DataFrame({
+                    'station': self.stations[at][station],
+                    'day': self.days[rows][day],
+                    'seuil': name,
+                    'jours': counts[day, station],
+                }))
+        return pd.concat(frames, ignore_index=True)
+
+_lowflow = (None, None)
+_lowflow_lock = threading.Lock()
+
+
+def get_lowflow_stats(qmj, stations_layer):
+    # Of qmj, the FlowData of the Qmj of a run. Computed once per version of the Qmj store, and only for the years with
+    # new days after an ingestion
+    global _lowflow
+    key = (qmj.version, stations_layer.filepath, stations_layer.mtime)
+    with _lowflow_lock:
+        previous_key, stats = _lowflow
+        if previous_key != key:
+            # Same store and layer, with more batches ingested
+            if stats is not None and previous_key[1:] == key[1:] and qmj.changed_since(previous_key[0]) is not None:
+                stats = stats.appended(qmj.matrix, qmj.version)
+            else:
+                stats = LowFlowStats(qmj.matrix, stations_layer.table.set_index('COD_STAT'), qmj.version)
+            _lowflow = (key, stats)
+        return _lowflow[1]
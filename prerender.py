@@ -0,0 +1,126 @@
+"""Pre-render the basin snapshot of each day of the Qmj history.
+
+A snapshot holds what the app shows for a day without a station filter: the
+basin state (stations with their Qmj and status, colours of the reaches and
+units), the threshold tables and heatmaps of every threshold and history,
+and the basin and rivers charts. They are rendered by the functions of the
+app, in a pool of forked processes, and stored by month by snapshots.py. The
+app reads the snapshot of a day it shows from there into its state cache,
+so that browsing past dates or animating the map doesn't compute them.
+
+Each day is stored with the version of the Qmj up to that day. Days already
+stored with the current one are skipped: an interrupted run resumes where
+it stopped, and after new rows are ingested only the days they change are
+rendered again.
+
+Snapshots are keyed on the contents of the layers and flows, not on their
+paths or mtimes, so they can be rendered on another machine than the app
+as long as it has the same data files: bin/post_compile renders them at
+build time, into the slug.
+
+    python prerender.py [--start 2020-01-01] [--end 2020-10-14] [--processes 4] [--force]
+"""
+import argparse
+import multiprocessing
+import os
+import time
+from datetime import datetime
+
+from snapshots import SnapshotMonth, compress_day, month_path, snapshot_dir, write_month
+from utils import (HISTORY_DAYS, QMJ_STATIONS, THRESHOLDS, drain_states, get_basin_chart, get_basin_state,
+                   get_river_chart, get_status_cube, get_threshold_heatmap, get_threshold_state, get_topology,
+                   load_sources)
+
+
+def status_cube_of(sources):
+    # The one of the app, with the same thresholds and stations
+    return get_status_cube(sources.qmj, sources.stations, sources.hydro, sources.ug, list(THRESHOLDS.values()), list(QMJ_STATIONS))
+
+
+def render_day(sources, status_cube, day):
+    """Fill the state cache with the unfiltered states and charts of day, as the app would"""
+    map_stations = get_basin_state(sources.stations, sources.qmj.matrix, status_cube, list(QMJ_STATIONS), day)[1]
+    get_basin_chart(map_stations, status_cube, day, sources.hydro.bounds)
+    get_river_chart(get_topology(sources.stations, sources.hydro, sources.ug), map_stations, status_cube, day)
+    for value, (threshold, column) in enumerate(THRESHOLDS.items(), 2):
+        for history_days in HISTORY_DAYS:
+            _, source = get_threshold_state(map_stations, status_cube, day, threshold, column, value, history_days)
+            if len(source) > 0:
+                get_threshold_heatmap(source, status_cube, day, threshold, history_days)
+
+
+# Sources and status cube of the batch, inherited by the forked workers
+_context = None
+
+
+def _render_month(task):
+    path, days = task
+    sources, status_cube = _context
+    # The other days of the month are kept as stored
+    stored = dict(SnapshotMonth(path).days)
+    for day in days:
+        render_day(sources, status_cube, day)
+        stored[day] = compress_day(status_cube.day_version(day), drain_states())
+    return path, len(days), write_month(path, stored)
+
+
+def prerender(start=None, end=None, processes=None, force=False):
+    """Render and store the snapshots of the days from start to end (all by default).
+
+    Returns (days rendered, bytes written, seconds).
+    """
+    global _context
+    # Read without the thread pool: no thread is running when the workers are forked
+    sources = load_sources(parallel=False)
+    if sources.errors:
+        raise RuntimeError(f'cannot load {", ".join(sources.errors)}')
+    status_cube = status_cube_of(sources)
+    directory = snapshot_dir(status_cube)
+    months = {}
+    for day in status_cube.days:
+        if (start is None or day >= start) and (end is None or day <= end):
+            months.setdefault(month_path(directory, day), []).append(day)
+    tasks = []
+    for path, days in months.items():
+        month = SnapshotMonth(path)
+        days = [day for day in days if force or month.version(day) != status_cube.day_version(day)]
+        if days:
+            tasks.append((path, days))
+    print(f'{directory}: {sum(len(days) for _, days in tasks)} days of {len(tasks)} of {len(months)} months to render')
+
+    # Built once before forking rather than in each worker
+    get_topology(sources.stations, sources.hydro, sources.ug)
+    _context = (sources, status_cube)
+    processes = processes or os.cpu_count() or 1
+    rendered = written = 0
+    start_time = time.perf_counter()
+    if processes > 1 and len(tasks) > 1:
+        with multiprocessing.get_context('fork').Pool(min(processes, len(tasks))) as pool:
+            results = list(_report(pool.imap_unordered(_render_month, tasks)))
+    else:
+        results = list(_report(map(_render_month, tasks)))
+    for _, days, size in results:
+        rendered += days
+        written += size
+    return rendered, written, time.perf_counter() - start_time
+
+
+def _report(results):
+    for path, days, size in results:
+        print(f'  {os.path.basename(path)}: {days} days, {size / 1024:.0f} KB')
+        yield path, days, size
+
+
+def _parse_day(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--start', type=_parse_day, help='first day, YYYY-MM-DD')
+    parser.add_argument('--end', type=_parse_day, help='last day, YYYY-MM-DD')
+    parser.add_argument('--processes', type=int, help='worker processes, the number of cores by default')
+    parser.add_argument('--force', action='store_true', help='render again the days already stored')
+    args = parser.parse_args()
+    days, size, seconds = prerender(args.start, args.end, args.processes, args.force)
+    print(f'{days} days in {seconds:.1f}s ({days / max(seconds, 1e-9):.1f} days/s), {size / 1024**2:.1f} MB')
@@ -0,0 +1,94 @@
+"""Store of the pre-rendered basin snapshots of each day, written by prerender.py and read by the app.
+
+A snapshot holds the state cache entries of a day without a station filter.
+They are stored by month in SNAPSHOT_DIR/<inputs>/<YYYY-MM>.snapshot, each
+day compressed apart with the version of the Qmj up to that day: ingesting
+the rows of later days leaves the snapshots of the earlier ones valid.
+"""
+import hashlib
+import os
+import pickle
+import zlib
+
+import altair as alt
+import pandas as pd
+
+from utils import FLOW_CACHE_DIR, FileCache, has_basin_state, put_states
+
+SNAPSHOT_DIR = os.environ.get('LVDLR_SNAPSHOT_DIR', os.path.join(FLOW_CACHE_DIR, 'snapshots'))
+# Bound of the compressed month files kept in memory by the app
+SNAPSHOT_CACHE_MAX_BYTES = int(os.environ.get('LVDLR_SNAPSHOT_CACHE_MB', 16)) * 1024**2
+
+
+def snapshot_dir(status_cube):
+    # Layers (hashes of their files), thresholds and stations of the cube; pickled frames and specs also depend on
+    # the versions of pandas and altair, and on the altair theme
+    inputs = repr((status_cube.inputs, pd.__version__, alt.__version__, alt.themes.active))
+    return os.path.join(SNAPSHOT_DIR, hashlib.sha1(inputs.encode()).hexdigest()[:16])
+
+
+def month_path(directory, day):
+    return os.path.join(directory, f'{day:%Y-%m}.snapshot')
+
+
+def compress_day(version, entries):
+    """Stored snapshot of a day: the day version of the cube and its (key, value, size) state cache entries"""
+    return version, zlib.compress(pickle.dumps(entries, protocol=4), 6)
+
+
+def write_month(path, days):
+    """Store the snapshots of the days of a month, as made by compress_day; returns the bytes written"""
+    data = pickle.dumps(days, protocol=4)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+class SnapshotMonth:
+    """Snapshots of the days of a month file, decompressed one day at a time"""
+
+    def __init__(self, path=None):
+        self._days = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                self._days = pickle.load(f)
+
+    @property
+    def nbytes(self):
+        return sum(len(data) for _, data in self._days.values())
+
+    @property
+    def days(self):
+        """Stored snapshots, by day"""
+        return self._days
+
+    def version(self, day):
+        """Day version of the snapshot of day, None if it isn't in the month"""
+        return self._days[day][0] if day in self._days else None
+
+    def entries(self, day):
+        """(key, value, size) state cache entries of day, none if it isn't in the month"""
+        if day not in self._days:
+            return []
+        return pickle.loads(zlib.decompress(self._days[day][1]))
+
+
+_snapshot_months = FileCache(SNAPSHOT_CACHE_MAX_BYTES)
+
+
+def load_snapshot(status_cube, day):
+    """Put the pre-rendered states and charts of day into the state cache, if stored, current and not there yet"""
+    if has_basin_state(status_cube, day):
+        return False
+    path = month_path(snapshot_dir(status_cube), day)
+    if not os.path.exists(path):
+        return False
+    month = _snapshot_months.get(path, SnapshotMonth)
+    if month.version(day) != status_cube.day_version(day):
+        return False
+    entries = month.entries(day)
+    put_states(entries)
+    return len(entries) > 0
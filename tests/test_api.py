@@ -0,0 +1,25 @@
+"""Values of the API tables, as JSON"""
+import json
+
+import pandas as pd
+
+import api
+import utils
+
+
+def data(path, query):
+    status, _, body = api.response(utils.load_sources(), path, query, 'json')
+    assert status == 200
+    return json.loads(body)['data']
+
+
+def test_flows_have_the_csv_decimals():
+    rows = pd.read_csv('data/hbv_qi.csv')
+    rows = rows[rows['code_station'] == 'O7094010']
+    flows = data('/flows', {'stations': 'O7094010', 'variable': 'qi', 'start': '2020-10-10', 'end': '2020-10-14'})
+    assert set(r['debit'] for r in flows) <= set(rows['debit'])
+
+
+def test_features_without_stations_have_no_status():
+    statuses = [r['status'] for path in ('/reaches', '/units') for r in data(path, {})]
+    assert None in statuses and -1 not in statuses
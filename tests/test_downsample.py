@@ -0,0 +1,36 @@
+"""downsample keeps the extremes of every bucket, of the flows and of the band of the Qi pyramid"""
+from datetime import timedelta
+
+import pandas as pd
+import pytest
+
+import utils
+
+
+def extremes(data, date_range, width):
+    # Lowest and highest debit, debit_min and debit_max per bucket of the chart
+    start, end = utils._day_bounds(date_range, data['date'].dtype.tz)
+    buckets = ((utils._epoch_ns(data['date']) - start) * width // (end - start)).clip(0, width - 1)
+    return data.groupby(buckets).agg({'debit': ['min', 'max'], 'debit_min': 'min', 'debit_max': 'max'})
+
+
+@pytest.mark.parametrize('level, width', [('1H', 780), ('1D', 40)])
+def test_band_extremes_kept(level, width):
+    rows = utils.get_qi_pyramid('data/hbv_qi.csv').index(level).select(['O7094010'])
+    date_range = (rows['date'].min().date(), rows['date'].max().date())
+    sampled = utils.downsample(rows, width, date_range)
+    assert len(sampled) < len(rows)
+    assert extremes(sampled, date_range, width).equals(extremes(rows, date_range, width))
+
+
+@pytest.mark.parametrize('level, weekday', [('1D', None), ('7D', 0)])
+def test_buckets_are_local_days(level, weekday):
+    pyramid = utils.get_qi_pyramid('data/hbv_qi.csv')
+    dates = pyramid.index(level).data['date']
+    assert (dates.dt.hour == 0).all() and (dates.dt.minute == 0).all()
+    if weekday is not None:
+        assert (dates.dt.weekday == weekday).all()
+    # The bucket of the first day of a range is selected even if it starts before it
+    first, last = dates.min().date() + timedelta(3), dates.max().date()
+    rows = pyramid.select(['O7094010'], (first, last), width=10)
+    assert rows['date'].min() <= pd.Timestamp(first).tz_localize(dates.dt.tz) < rows['date'].min() + timedelta(7)
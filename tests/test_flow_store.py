@@ -0,0 +1,145 @@
+"""FlowStore versions and what is derived from its rows as they are ingested"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils
+
+THRESHOLD_COLUMNS = list(utils.THRESHOLDS.values())
+CUT = '2020-09-01'
+
+
+@pytest.fixture
+def qmj(tmp_path, monkeypatch):
+    # Qmj before CUT as the base CSV, and the incoming directory for the rest
+    monkeypatch.setattr(utils, 'FLOW_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(utils, 'INCOMING_DIR', str(tmp_path / 'incoming'))
+    rows = pd.read_csv('data/hbv_qmj.csv')
+    base = str(tmp_path / 'hbv_qmj.csv')
+    rows[rows['date'] < CUT].to_csv(base, index=False)
+    os.makedirs(tmp_path / 'incoming' / 'hbv_qmj')
+    return base, rows[rows['date'] >= CUT].sort_values('date', kind='mergesort')
+
+
+def drop(rows, name, directory='hbv_qmj'):
+    rows.to_csv(os.path.join(utils.INCOMING_DIR, directory, name), index=False)
+
+
+def test_version_identifies_rows(qmj):
+    base, rest = qmj
+    store = utils.FlowStore(base, daily=True)
+    base_version = store.version
+    drop(rest, 'a.csv')
+    store.refresh()
+    # Another process, or a restart, reading the same files
+    assert utils.FlowStore(base, daily=True).version == store.version != base_version
+    assert store.changed_since(base_version) == pd.Timestamp(CUT).date()
+    assert store.changed_since(store.version) is None
+
+    # The drop file rewritten with other flows
+    drop(rest.assign(debit=rest['debit'] * 2), 'a.csv')
+    assert utils.FlowStore(base, daily=True).version not in (base_version, store.version)
+
+
+def test_bad_file_is_skipped(qmj, caplog):
+    base, rest = qmj
+    bad = os.path.join(utils.INCOMING_DIR, 'hbv_qmj', '0.csv')
+    with open(bad, 'w') as f:
+        f.write('code_station,date,debit\nO7202510,not-a-date,1.0\n')
+    drop(rest, 'a.csv')
+    store = utils.FlowStore(base, daily=True)
+    # The other files are ingested, and the bad one is only read again once changed
+    assert store.matrix.index[-1] == pd.Timestamp(rest['date'].max()).date()
+    assert '0.csv skipped' in caplog.text
+    caplog.clear()
+    store.refresh()
+    assert caplog.text == ''
+
+
+def test_status_cube_appended(qmj):
+    base, rest = qmj
+    store = utils.FlowStore(base, daily=True)
+    layers = [utils.get_layer(f'data/{name}.geojson') for name in ('stations', 'hydrographie', 'ss-unites-gestion')]
+    engine = utils.get_status_engine(*layers, THRESHOLD_COLUMNS)
+    cube = utils.StatusCube(store.snapshot(), engine, utils.QMJ_STATIONS)
+
+    for part in np.array_split(np.arange(len(rest)), 3):
+        version = store.version
+        drop(rest.iloc[part], f'{part[0]}.csv')
+        store.refresh()
+        cube = cube.appended(store.snapshot(), store.changed_since(version))
+
+    full = utils.StatusCube(store.snapshot(), engine, utils.QMJ_STATIONS)
+    assert list(cube.days) == list(full.days)
+    for level, expected in zip(cube.levels, full.levels):
+        np.testing.assert_array_equal(level, expected)
+
+
+def test_version_until_day(qmj):
+    base, rest = qmj
+    store = utils.FlowStore(base, daily=True)
+    before = store.snapshot()
+    drop(rest, 'a.csv')
+    store.refresh()
+    after = store.snapshot()
+    # Days before the ingested rows keep their version, the later ones move with the store
+    day, cut = pd.Timestamp(CUT).date() - pd.Timedelta(days=1), pd.Timestamp(CUT).date()
+    assert after.version_until(day) == before.version_until(day) == before.version
+    assert after.version_until(cut) == after.version != before.version_until(cut)
+
+
+def test_qi_appended_like_loaded(tmp_path, monkeypatch):
+    # Qi before CUT as the base CSV, without one station, and the rest in date-ordered drops
+    monkeypatch.setattr(utils, 'FLOW_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(utils, 'INCOMING_DIR', str(tmp_path / 'incoming'))
+    os.makedirs(tmp_path / 'incoming' / 'hbv_qi')
+    rows = pd.read_csv('data/hbv_qi.csv')
+    in_base = (rows['date'] < CUT) & (rows['code_station'] != 'O7145220')
+    base = str(tmp_path / 'hbv_qi.csv')
+    rows[in_base].to_csv(base, index=False)
+    store = utils.FlowStore(base, 'Europe/Paris')
+    rest = rows[~in_base].sort_values('date', kind='mergesort')
+    for i, part in enumerate(np.array_split(rest, 3)):
+        # Derived structures are built, so they are extended rather than built from the ingested rows
+        store.matrix, store.pyramid
+        drop(part, f'{i}.csv', 'hbv_qi')
+        store.refresh()
+
+    full = str(tmp_path / 'full' / 'hbv_qi.csv')
+    os.makedirs(os.path.dirname(full))
+    rows.to_csv(full, index=False)
+    loaded = utils.FlowStore(full, 'Europe/Paris')
+    pd.testing.assert_frame_equal(store.data, loaded.data)
+    np.testing.assert_array_equal(store.index.dates, loaded.index.dates)
+    np.testing.assert_array_equal(store.index.offsets, loaded.index.offsets)
+    assert list(store.index.stations) == list(loaded.index.stations)
+    for name in utils.PYRAMID_STEPS:
+        pd.testing.assert_frame_equal(store.pyramid.levels[name], loaded.pyramid.levels[name])
+    # The freq a full pivot infers is only metadata of its index
+    pd.testing.assert_frame_equal(store.matrix, loaded.matrix, check_freq=False)
+
+
+def test_snapshot_keeps_its_rows(qmj):
+    base, rest = qmj
+    store = utils.FlowStore(base, daily=True)
+    data = store.snapshot()
+    version, matrix, index = data.version, data.matrix, data.index
+    drop(rest, 'a.csv')
+    store.refresh()
+    # What a run loaded still describes the rows it was loaded with
+    assert store.version != data.version == version
+    assert data.matrix is matrix and data.index is index
+    assert data.matrix.index[-1] < pd.Timestamp(CUT).date() <= store.matrix.index[-1]
+    assert len(data.pyramid.base.data) == len(data.data) < len(store.data)
+
+
+@pytest.mark.parametrize('filepath, tz, daily', [('data/hbv_qmj.csv', None, True), ('data/hbv_qi.csv', 'Europe/Paris', False)], ids=['qmj', 'qi'])
+def test_rows_are_read_only(filepath, tz, daily):
+    data = utils.get_store(filepath, tz, daily).data
+    for column in data.columns:
+        value = data.at[0, column]
+        with pytest.raises(ValueError, match='read-only'):
+            data.at[0, column] = data.at[len(data) - 1, column]
+        assert data.at[0, column] == value
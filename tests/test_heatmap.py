@@ -0,0 +1,20 @@
+"""status_history gives the heatmap source of the DataFrame.append loop it replaced"""
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+import utils
+from benchmarks.bench_heatmap import append_loop
+
+
+@pytest.mark.filterwarnings('ignore::FutureWarning')
+@pytest.mark.parametrize('days', utils.HISTORY_DAYS)
+def test_status_history_matches_append_loop(days):
+    status = np.random.default_rng(days).integers(0, 6, (12, days)).astype(np.int8)
+    stations = [f'S{i:03d}' for i in range(len(status))]
+    dates = [date(2020, 8, 15) - timedelta(i) for i in range(days)]
+    expected = append_loop(status, stations, dates)
+    source = utils.status_history(status, stations, dates)
+    assert list(source.columns) == list(expected.columns)
+    assert (source.astype({'status': int}).values == expected.astype({'status': int}).values).all()
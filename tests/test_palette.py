@@ -0,0 +1,15 @@
+"""status_colors gives the colours of get_status_color, clamped to 0-255 and opaque when there is no alpha"""
+import numpy as np
+import pytest
+
+import utils
+
+CODES = [-1, 0, 1, 2, 3, 4, 5, 6, np.nan]
+
+
+@pytest.mark.parametrize('layer_type', utils.LAYER_TYPES)
+def test_palette_matches_get_status_color(layer_type):
+    expected = np.clip([rgb + [255] * (4 - len(rgb)) for rgb in (utils.get_status_color(x, layer_type) for x in CODES)], 0, 255)
+    assert (utils.status_colors(CODES, layer_type) == expected).all()
+    # Codes of the status cube
+    assert (utils.status_colors(np.array(CODES[:-1], dtype=np.int8), layer_type) == expected[:-1]).all()
@@ -0,0 +1,20 @@
+"""to_local_time is exact across the DST changes of Europe/Paris"""
+import numpy as np
+import pandas as pd
+import pytest
+import pytz
+
+from utils import to_local_time
+
+PARIS = pytz.timezone('Europe/Paris')
+
+
+@pytest.mark.parametrize('start', ['2020-03-28 22:00', '2020-10-24 22:00'], ids=['2020-03-29', '2020-10-25'])
+def test_dst_change(start):
+    utc_times = pd.date_range(start, periods=8*4, freq='15min')
+    local = to_local_time(utc_times.values.view(np.int64))
+    expected = [PARIS.normalize(pytz.UTC.localize(t.to_pydatetime()).astimezone(PARIS)) for t in utc_times]
+    assert list(local) == expected
+    # 15 min apart in absolute time, even when the wall clock jumps or repeats
+    assert (np.diff(local.asi8) == 15*60*10**9).all()
+    assert {str(t.utcoffset()) for t in local} == {'1:00:00', '2:00:00'}
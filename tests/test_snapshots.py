@@ -0,0 +1,28 @@
+"""Snapshots are keyed on the contents of the data, not on the mtimes of their files"""
+import os
+import shutil
+
+import utils
+from snapshots import snapshot_dir
+
+
+def status_cube(stations_path):
+    sources = utils.load_sources()
+    stations = utils.get_layer(stations_path)
+    return utils.get_status_cube(sources.qmj, stations, sources.hydro, sources.ug, list(utils.THRESHOLDS.values()),
+                                 utils.QMJ_STATIONS)
+
+
+def test_directory_is_keyed_on_contents(tmp_path):
+    stations = str(tmp_path / 'stations.geojson')
+    shutil.copyfile('data/stations.geojson', stations)
+    cube = status_cube(stations)
+    # The same file deployed or touched again: the layer and the cube are rebuilt, the snapshots still match
+    os.utime(stations, (0, 0))
+    other = status_cube(stations)
+    assert other is not cube
+    assert snapshot_dir(other) == snapshot_dir(cube)
+
+    with open(stations, 'a') as f:
+        f.write('\n')
+    assert snapshot_dir(status_cube(stations)) != snapshot_dir(cube)
@@ -0,0 +1,58 @@
+"""classify_flows and the topology roll-up give the codes of get_station_status, get_hydro_status and get_ug_status"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils
+
+THRESHOLD_COLUMNS = list(utils.THRESHOLDS.values())
+
+
+@pytest.fixture(scope='module')
+def layers():
+    return tuple(utils.get_layer(f'data/{name}.geojson') for name in ('stations', 'hydrographie', 'ss-unites-gestion'))
+
+
+@pytest.fixture(scope='module')
+def flows(layers):
+    # (stations x days) Qmj of the whole history, NaN where a station has none
+    matrix = utils.get_qmj_matrix('data/hbv_qmj.csv')
+    return matrix.reindex(columns=layers[0].table['COD_STAT']).to_numpy(dtype=float).T
+
+
+def unordered(stations):
+    # A missing DA and a DOE under the DC: both take the np.select cascade
+    stations = stations.copy()
+    stations.loc[3, 'Q_80pDOE_m3'] = np.nan
+    stations.loc[5, 'Q_Obj_m3'] = 0.05
+    return stations
+
+
+@pytest.mark.parametrize('thresholds', [lambda stations: stations, unordered], ids=['as is', 'unordered'])
+def test_status_matches_legacy(layers, flows, thresholds):
+    stations, hydro, ug = layers[0].table, layers[1].table, layers[2].table
+    stations = thresholds(stations)
+    engine = utils.StatusEngine(utils.TopologyIndex(stations, hydro, ug), stations, THRESHOLD_COLUMNS)
+    station_status, hydro_status, ug_status = engine.status(flows)
+
+    values = stations[THRESHOLD_COLUMNS].to_numpy(dtype=float)
+    expected = np.array([[utils.get_station_status(q, *values[i]) for q in flows[i]] for i in range(len(flows))])
+    np.testing.assert_array_equal(station_status, expected)
+
+    for day in range(flows.shape[1]):
+        day_status = pd.Series(expected[:, day])
+        day_hydro = pd.Series([utils.get_hydro_status(x, day_status, stations['ID_hydrographie']) for x in hydro['ID_hydrographie']])
+        day_ug = pd.Series([utils.get_ug_status(x, day_hydro, hydro['ID_ss-unite-gestion']) for x in ug['ID_ss-unite-gestion']])
+        # Groups without members are NaN for the legacy functions, -1 for the roll-up
+        np.testing.assert_array_equal(hydro_status[:, day], day_hydro.fillna(-1).to_numpy(), err_msg=f'reaches, day {day}')
+        np.testing.assert_array_equal(ug_status[:, day], day_ug.fillna(-1).to_numpy(), err_msg=f'units, day {day}')
+
+
+def test_unordered_thresholds_at_every_flow(layers):
+    # Flows at, between and around each threshold of the unordered stations, whatever their history
+    values = unordered(layers[0].table)[THRESHOLD_COLUMNS].to_numpy(dtype=float)[[3, 5]]
+    edges = np.unique(values[np.isfinite(values)])
+    flows = np.r_[np.nan, 0, edges, edges * 0.999, edges * 1.001, edges.max() * 2]
+    flows = np.tile(flows, (len(values), 1))
+    expected = [[utils.get_station_status(q, *values[i]) for q in flows[i]] for i in range(len(values))]
+    np.testing.assert_array_equal(utils.classify_flows(flows, values), expected)
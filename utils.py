@@ -6,34 +6,1317 @@ import geopandas as gpd
 import json
 import numpy as np
 import altair as alt
+import pyarrow as pa
+from pyarrow import feather
+import os
+import sys
+import threading
+import logging
+import hashlib
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from contextlib import contextmanager
+from pandas.api.types import union_categoricals
+from shapely.geometry import mapping
 
 from math import pi
 from bokeh.plotting import figure
 from bokeh.transform import cumsum
 
 from time import mktime
+import time as tt
 from datetime import datetime, time, timedelta, date
 import pytz
 
 utc=pytz.UTC
 
+LAYER_CACHE_MAX_BYTES = int(os.environ.get('LVDLR_LAYER_CACHE_MB', 64)) * 1024**2
+FLOW_CACHE_MAX_BYTES = int(os.environ.get('LVDLR_FLOW_CACHE_MB', 192)) * 1024**2
+FLOW_CACHE_DIR = os.environ.get('LVDLR_CACHE_DIR', os.path.join('data', 'cache'))
+# New flow CSVs are dropped in INCOMING_DIR/<name of the base CSV>/, looked for at most every INGEST_INTERVAL seconds.
+# Only *.csv files are read: write them under another name and rename them once complete
+INCOMING_DIR = os.environ.get('LVDLR_INCOMING_DIR', os.path.join('data', 'incoming'))
+INGEST_INTERVAL = float(os.environ.get('LVDLR_INGEST_INTERVAL', 30))
+# Width of the flow chart in the wide layout, i.e. the number of min/max buckets per station
+CHART_WIDTH_PX = int(os.environ.get('LVDLR_CHART_WIDTH_PX', 1200))
+# Zooms from which each simplified level of the map geometries is used, coarsest first
+MAP_LOD_ZOOMS = (6, 8, 10, 12)
+# Bound of the per-date states shared by all sessions
+STATE_CACHE_MAX_BYTES = int(os.environ.get('LVDLR_STATE_CACHE_MB', 64)) * 1024**2
+# Instrumentation of every run, also turned on for a page opened with ?profile=1
+PROFILE = os.environ.get('LVDLR_PROFILE', '') not in ('', '0')
+# Threads reading the data sources concurrently, 0 to read them one after another
+LOAD_WORKERS = int(os.environ.get('LVDLR_LOAD_WORKERS', 5))
 
-@st.cache
-def get_qmj(filepath):
-    df = pd.read_csv(filepath, sep=',')
-    df['date'] = pd.to_datetime(df['date']).dt.date
+# Days of status history offered next to the threshold table
+HISTORY_DAYS = (7, 30, 90)
+# Flow thresholds of the basin, from the highest to the lowest: name -> column of stations.geojson
+THRESHOLDS = OrderedDict([
+    ('DOE', 'Q_Obj_m3'),
+    ('DA', 'Q_80pDOE_m3'),
+    ('DAR', 'Q_alerte_renf'),
+    ('DC', 'Q_Crise_m3'),
+])
+# Stations whose Qmj is shown and classified on the map
+QMJ_STATIONS = ['O6140010','O9000010','O8584010','O8394310','O8344020','O8255010','O8264010','O8113520','O8133520','O7434010','O7354010','O7635010','O7265010','O7234030','O7234010','O7272510','O7202510','O7410401','O7444010','O7245010','GOUL','O7515510','O7535010','O7094010','O7054010','O7074020','O7085010','O7874010','O7825010','O7944020','O7145220','O7035010','O7001510','O7041510','O7101510','O7191510','O7161510_E','O7021530','O7015810','O8661520','COUTET','CAHEDF','O8231530','ENTEDF','O7701540','O7971510']
+
+# One JSON line per instrumented run on stderr, which ends up in the dyno logs
+profile_log = logging.getLogger('lvdlr.profile')
+if not profile_log.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    profile_log.addHandler(_handler)
+    profile_log.setLevel(logging.INFO)
+    profile_log.propagate = False
+
+# Flow CSVs of the incoming directories that cannot be read
+ingest_log = logging.getLogger('lvdlr.ingest')
+
+
+class FileCache:
+    """Process-wide LRU of objects built from files, bounded in bytes.
+
+    An entry is rebuilt when the modification time of its source file changes,
+    so dropping a new file in data/ doesn't require a restart. Entries of
+    different keys are built concurrently, each key by one caller at a time.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._building = {}
+        self._lock = threading.RLock()
+
+    def _lookup(self, key, mtime):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == mtime:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            return None
+
+    def get(self, filepath, build, key=None):
+        # key tells apart several objects built from the same file
+        key = filepath if key is None else key
+        mtime = os.path.getmtime(filepath)
+        entry = self._lookup(key, mtime)
+        if entry is not None:
+            return entry[1]
+        with self._lock:
+            building = self._building.setdefault(key, threading.Lock())
+        with building:
+            # Built meanwhile by the caller that held the key
+            entry = self._lookup(key, mtime)
+            if entry is not None:
+                return entry[1]
+            with self._lock:
+                self.misses += 1
+            value = build(filepath)
+            with self._lock:
+                self._entries[key] = (mtime, value)
+                self._entries.move_to_end(key)
+                self._evict()
+            return value
+
+    @property
+    def nbytes(self):
+        return sum(_nbytes(value) for _, value in self._entries.values())
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'nbytes': self.nbytes}
+
+    def _evict(self):
+        # Always keep the most recent entry, even if it is bigger than the cap
+        while len(self._entries) > 1 and self.nbytes > self.max_bytes:
+            self._entries.popitem(last=False)
+
+
+class SharedCache:
+    """Process-wide LRU of computed values shared by all sessions, bounded in bytes.
+
+    Concurrent gets of a missing key are coalesced (single flight): the first
+    caller builds the value while the others wait for it instead of building
+    it again. hits, misses and waits count the gets of each kind.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = self.misses = self.waits = 0
+        self._entries = OrderedDict()
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            flight = self._building.get(key)
+            owner = flight is None
+            if owner:
+                flight = self._building[key] = {'done': threading.Event()}
+                self.misses += 1
+            else:
+                self.waits += 1
+
+        if not owner:
+            flight['done'].wait()
+            if 'error' in flight:
+                raise flight['error']
+            return flight['value']
+
+        try:
+            value = flight['value'] = build()
+        except Exception as error:
+            flight['error'] = error
+            raise
+        else:
+            size = _nbytes(value)
+            with self._lock:
+                self._entries[key] = (value, size)
+                self.nbytes += size
+                self._evict()
+            return value
+        finally:
+            with self._lock:
+                del self._building[key]
+            flight['done'].set()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key, value, size=None):
+        """Add a value built elsewhere, e.g. read from a snapshot, unless key is already there"""
+        size = _nbytes(value) if size is None else size
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (value, size)
+                self.nbytes += size
+                self._evict()
+
+    def drain(self):
+        """Remove all the entries, and return them as (key, value, size) from the oldest"""
+        with self._lock:
+            entries = [(key, value, size) for key, (value, size) in self._entries.items()]
+            self._entries.clear()
+            self.nbytes = 0
+            return entries
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'waits': self.waits, 'entries': len(self._entries), 'nbytes': self.nbytes}
+
+    def _evict(self):
+        # Always keep the most recent entry, even if it is bigger than the cap
+        while len(self._entries) > 1 and self.nbytes > self.max_bytes:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.nbytes -= size
+
+
+def _nbytes(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, tuple):
+        return sum(_nbytes(x) for x in value)
+    if isinstance(value, ChartSpec):
+        return _sizeof(value.spec) + sum(_nbytes(frame) for frame in value.datasets.values())
+    if isinstance(value, pdk.Deck):
+        return sum(_sizeof(layer.data) for layer in value.layers)
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    return _sizeof(value)
+
+
+def _sizeof(obj):
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        size += sum(_sizeof(x) for x in obj)
+    elif isinstance(obj, dict):
+        size += sum(_sizeof(x) for x in obj.values())
+    return size
+
+
+class StageTimer:
+    """Wall time of the consecutive stages of a run, e.g. of main(), summed by stage name.
+
+    With measure_charts, show_altair_chart also records the size of each chart spec.
+    """
+
+    def __init__(self, measure_charts=False):
+        self.stages = OrderedDict()
+        self.charts = []
+        self.measure_charts = measure_charts
+        self.current = None
+        self._started = None
+
+    def start(self, name):
+        now = tt.perf_counter()
+        self.stop(now)
+        self.current, self._started = name, now
+        ## Listed from their first start, before the stages added meanwhile
+        self.stages.setdefault(name, 0)
+
+    def add(self, name, seconds):
+        # Time spent on name outside of the consecutive stages, e.g. in another thread
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def stop(self, now=None):
+        if self.current is not None:
+            elapsed = (now or tt.perf_counter()) - self._started
+            self.stages[self.current] = self.stages.get(self.current, 0) + elapsed
+            self.current = None
+
+
+_stage_timer = threading.local()
+
+
+@contextmanager
+def record_stages(measure_charts=False):
+    """Time the stages marked with stage() by this thread, e.g. around a run of main()"""
+    previous = getattr(_stage_timer, 'timer', None)
+    timer = _stage_timer.timer = StageTimer(measure_charts)
+    try:
+        yield timer
+    finally:
+        timer.stop()
+        _stage_timer.timer = previous
+
+
+def stage(name):
+    """Start the stage name of the current run, ending the previous one. Does nothing unless stages are recorded."""
+    timer = getattr(_stage_timer, 'timer', None)
+    if timer is not None:
+        timer.start(name)
+
+
+def record_stage(name, seconds):
+    """Add seconds to the stage name of the current run, e.g. for work done by other threads. Does nothing unless stages are recorded."""
+    timer = getattr(_stage_timer, 'timer', None)
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+@contextmanager
+def substage(name):
+    """Time a block as the stage name, then go back to the enclosing stage"""
+    timer = getattr(_stage_timer, 'timer', None)
+    previous = None if timer is None else timer.current
+    stage(name)
+    try:
+        yield
+    finally:
+        if previous is not None:
+            timer.start(previous)
+
+
+def _frame_digest(frame):
+    # Hash of the columns, dtypes, index and values of a frame
+    header = json.dumps([[str(column), str(dtype)] for column, dtype in frame.dtypes.items()])
+    return hashlib.sha1(header.encode() + pd.util.hash_pandas_object(frame, index=True).values.tobytes()).hexdigest()[:16]
+
+
+def _spec_strings(spec):
+    # Every string of a Vega-Lite spec, e.g. field names and expressions, but the channels selections project on
+    if isinstance(spec, dict):
+        spec = [value for key, value in spec.items() if key != 'encodings']
+    if isinstance(spec, list):
+        for value in spec:
+            yield from _spec_strings(value)
+    elif isinstance(spec, str):
+        yield spec
+
+
+def _spec_columns(spec, columns):
+    # Columns used as a field, or in an expression as datum.column or datum['column']
+    strings = set(_spec_strings(spec))
+    expressions = [string for string in strings if 'datum' in string]
+    return [column for column in columns if str(column) in strings or any(
+        f'datum.{column}' in expression or f'datum["{column}"]' in expression or f"datum['{column}']" in expression for expression in expressions)]
+
+
+_chart_spec_lock = threading.Lock()
+
+
+class ChartSpec:
+    """Vega-Lite spec of an altair chart, with its DataFrames apart as named datasets.
+
+    Datasets keep only the columns the spec refers to, and are named after a
+    hash of their content: a frame used by several layers is sent once, and a
+    chart built again from the same data gives the same spec. Streamlit then
+    sends it as a reference to the message the browser already has. Built
+    once per section, the spec is shown on each rerun without altair
+    converting and validating the chart again.
+    """
+
+    def __init__(self, chart):
+        frames = []
+
+        def collect(data):
+            frames.append(data)
+            return {'name': f'__chart_data_{len(frames) - 1}__'}
+
+        # The data transformers of altair are global
+        with _chart_spec_lock:
+            alt.data_transformers.register('chart_spec', collect)
+            with alt.data_transformers.enable('chart_spec'):
+                spec = chart.to_dict()
+        text = json.dumps(spec, ensure_ascii=False)
+
+        self.datasets = OrderedDict()
+        for i, frame in enumerate(frames):
+            frame = frame[_spec_columns(spec, frame.columns)]
+            name = f'data-{_frame_digest(frame)}'
+            self.datasets.setdefault(name, frame)
+            text = text.replace(f'"__chart_data_{i}__"', f'"{name}"')
+        self.spec = json.loads(text)
+        self.digest = hashlib.sha1(text.encode()).hexdigest()[:16]
+        self._text_bytes = len(text.encode())
+        self._payload_bytes = None
+
+    @property
+    def payload_bytes(self):
+        """Bytes of the spec plus its datasets as JSON records, about what a rerun sends"""
+        if self._payload_bytes is None:
+            self._payload_bytes = self._text_bytes + sum(len(frame.to_json(orient='records', date_format='iso', default_handler=str))
+                                                        for frame in self.datasets.values())
+        return self._payload_bytes
+
+
+def show_altair_chart(chart, name, **kwargs):
+    """Show a ChartSpec (or an altair chart) with st.vega_lite_chart, recording its size when profiling"""
+    if not isinstance(chart, ChartSpec):
+        chart = ChartSpec(chart)
+    timer = getattr(_stage_timer, 'timer', None)
+    start = tt.perf_counter()
+    # Streamlit pulls the datasets out of a copy of the spec
+    st.vega_lite_chart(dict(chart.spec, datasets=chart.datasets), **kwargs)
+    if timer is not None and timer.measure_charts:
+        timer.charts.append({'chart': name, 'bytes': chart.payload_bytes, 'digest': chart.digest, 'seconds': tt.perf_counter() - start})
+
+
+def show_pydeck_chart(deck, name, placeholder=None, **kwargs):
+    """st.pydeck_chart, or in placeholder (an st.empty()), recording the size of the deck spec when profiling"""
+    timer = getattr(_stage_timer, 'timer', None)
+    if timer is not None and timer.measure_charts:
+        start = tt.perf_counter()
+        size = len(deck.to_json())
+        timer.charts.append({'chart': name, 'bytes': size, 'seconds': tt.perf_counter() - start})
+    (placeholder or st).pydeck_chart(deck, **kwargs)
+
+
+def _rss():
+    # Resident memory of the process, from /proc on Linux (dynos) or the peak elsewhere
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def cache_stats():
+    return {'layers': _layer_cache.stats(), 'flows': _flow_cache.stats(), 'states': _state_cache.stats()}
+
+
+def profiling_enabled():
+    return PROFILE or st.experimental_get_query_params().get('profile', ['0'])[0] not in ('', '0')
+
+
+def profile_run(main):
+    """Run main, instrumented if profiling_enabled().
+
+    Stage times, chart sizes, cache hit rates and RSS are logged as one JSON
+    line on the lvdlr.profile logger, and shown in a sidebar expander.
+    """
+    if not profiling_enabled():
+        return main()
+    start = tt.perf_counter()
+    with record_stages(measure_charts=True) as timer:
+        try:
+            main()
+        finally:
+            timer.stop()
+            caches = cache_stats()
+            report = {
+                'event': 'run',
+                'dyno': os.environ.get('DYNO'),
+                'pid': os.getpid(),
+                'total_ms': round((tt.perf_counter() - start) * 1000, 1),
+                'stages_ms': {name: round(seconds * 1000, 1) for name, seconds in timer.stages.items()},
+                'charts': [{**chart, 'seconds': round(chart['seconds'], 4)} for chart in timer.charts],
+                'charts_kb': round(sum(chart['bytes'] for chart in timer.charts) / 1024, 1),
+                'caches': {name: {**stats, 'hit_rate': round(stats['hits'] / max(1, stats['hits'] + stats['misses']), 3)} for name, stats in caches.items()},
+                'rss_mb': round(_rss() / 1024**2, 1),
+            }
+            profile_log.info(json.dumps(report))
+            show_profile(report)
+
+
+def show_profile(report):
+    with st.sidebar.beta_expander('Instrumentation', expanded=True):
+        st.markdown(f"**{report['total_ms']} ms** au total, RSS {report['rss_mb']} Mo")
+        st.table(pd.DataFrame({'ms': report['stages_ms']}))
+        if report['charts']:
+            st.markdown(f"Graphiques : {report['charts_kb']} ko")
+            st.table(pd.DataFrame(report['charts']).set_index('chart'))
+        st.table(pd.DataFrame(report['caches']).T[['hits', 'misses', 'hit_rate', 'entries', 'nbytes']])
+
+
+def lod_tolerance(zoom):
+    """Half the width of a screen pixel at zoom (256px tiles), in degrees"""
+    return 180 / (256 * 2**zoom)
+
+
+def _quantize_part(coords, decimals, min_points):
+    q = np.round(np.asarray(coords, dtype=float), decimals)
+    keep = np.ones(len(q), dtype=bool)
+    keep[1:] = (q[1:] != q[:-1]).any(axis=1)
+    # Don't let rounding collapse a line or a ring
+    if keep.sum() >= min_points:
+        q = q[keep]
+    return tuple(map(tuple, q.tolist()))
+
+
+def quantize_geometry(geometry, decimals):
+    """Round the coordinates of a GeoJSON mapping and drop the repeated points it creates"""
+    kind = geometry['type']
+    if kind == 'GeometryCollection':
+        return {'type': kind, 'geometries': tuple(quantize_geometry(g, decimals) for g in geometry['geometries'])}
+    coords = geometry['coordinates']
+    if kind == 'Point':
+        coords = tuple(round(c, decimals) for c in coords)
+    elif kind in ('LineString', 'MultiPoint'):
+        coords = _quantize_part(coords, decimals, 2 if kind == 'LineString' else 1)
+    elif kind in ('MultiLineString', 'Polygon'):
+        coords = tuple(_quantize_part(part, decimals, 2 if kind == 'MultiLineString' else 4) for part in coords)
+    else:
+        coords = tuple(tuple(_quantize_part(ring, decimals, 4) for ring in polygon) for polygon in coords)
+    return {'type': kind, 'coordinates': coords}
+
+
+class GeoLayer:
+    """GeoJSON layer parsed once: attribute table plus pydeck-ready geometries.
+
+    Besides the full geometries, one simplified level is kept per zoom of
+    lod_zooms: simplified to half a pixel at that zoom (topology preserved within
+    each feature) and quantized to a tenth of that.
+    """
+
+    def __init__(self, filepath, lod_zooms=MAP_LOD_ZOOMS):
+        self.filepath = filepath
+        self.mtime = os.path.getmtime(filepath)
+        # Identifies the file in any process or machine, unlike its mtime
+        with open(filepath, 'rb') as f:
+            self.version = hashlib.sha1(f.read()).hexdigest()[:16]
+        gdf = gpd.read_file(filepath)
+        self.bounds = gdf.total_bounds
+        # GeoJSON mappings are made of tuples, so they can be shared between reruns
+        self.geometry = tuple(None if g is None else mapping(g) for g in gdf.geometry)
+        self.lod_zooms = tuple(sorted(lod_zooms))
+        self.levels = {}
+        for zoom in self.lod_zooms:
+            tolerance = lod_tolerance(zoom)
+            decimals = min(6, int(np.ceil(-np.log10(tolerance / 10))))
+            simplified = gdf.geometry.simplify(tolerance, preserve_topology=True)
+            self.levels[zoom] = tuple(None if g is None or g.is_empty else quantize_geometry(mapping(g), decimals) for g in simplified)
+        self.table = pd.DataFrame(gdf.drop(columns='geometry'))
+        self._by_key = {}
+        self.nbytes = int(self.table.memory_usage(deep=True).sum()) + _sizeof(self.geometry) + _sizeof(self.levels)
+
+    def level_for(self, zoom):
+        """Coarsest level within half a pixel at zoom, None past the most detailed one"""
+        return min([z for z in self.lod_zooms if z >= zoom], default=None)
+
+    def geometries(self, zoom=None):
+        """Full geometries, or the level of detail for zoom"""
+        level = None if zoom is None else self.level_for(zoom)
+        return self.geometry if level is None else self.levels[level]
+
+    def frame(self):
+        # Copy of the cached table, which is shared by all sessions and by the structures built from it (TopologyIndex,
+        # StatusEngine): a few dozen rows, so a deep copy costs about as little as a shallow one and can be written to
+        return self.table.copy()
+
+    def to_pydeck(self, frame, columns=None, key=None, zoom=None):
+        """Build pydeck GeoJsonLayer data from the cached geometries and the rows of frame.
+
+        Records are laid out like pydeck does for a GeoDataFrame (attributes at the
+        top level next to 'geometry'), so accessors such as "color" keep working.
+        frame is indexed by feature position, or by the values of the attribute
+        key if given. Geometries are shared, not copied: the full ones, or the
+        level of detail for zoom.
+        """
+        geometry = self.geometries(zoom)
+        if key is not None:
+            level = None if zoom is None else self.level_for(zoom)
+            if (key, level) not in self._by_key:
+                self._by_key[key, level] = dict(zip(self.table[key], geometry))
+            geometry = self._by_key[key, level]
+
+        properties = frame if columns is None else frame[columns]
+        properties = properties.astype(object).where(properties.notna(), None)
+        records = properties.to_dict(orient='records')
+        for i, record in zip(frame.index, records):
+            record['geometry'] = geometry[i]
+        return records
+
+    def colored(self, zoom=None, **colors):
+        """pydeck GeoJsonLayer data carrying nothing but the geometry and its colours.
+
+        Each keyword binds an accessor name to an (n, 4) uint8 RGBA buffer indexed
+        by feature id, i.e. the position of the feature in the layer.
+        """
+        geometry = self.geometries(zoom)
+        colors = {name: buffer.tolist() for name, buffer in colors.items()}
+        records = [{'geometry': g} for g in geometry]
+        for name, values in colors.items():
+            for record, value in zip(records, values):
+                record[name] = value
+        return records
+
+
+_layer_cache = FileCache(LAYER_CACHE_MAX_BYTES)
+
+
+def get_layer(filepath):
+    return _layer_cache.get(filepath, GeoLayer)
+
+
+def flow_cache_path(filepath):
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    return os.path.join(FLOW_CACHE_DIR, f'{name}.feather')
+
+
+def _source_stamp(filepath):
+    stat = os.stat(filepath)
+    return {b'source_mtime_ns': str(stat.st_mtime_ns).encode(), b'source_size': str(stat.st_size).encode()}
+
+
+def flow_cache_is_fresh(filepath, cache_path=None):
+    cache_path = cache_path or flow_cache_path(filepath)
+    if not os.path.exists(cache_path):
+        return False
+    with pa.memory_map(cache_path) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    stamp = _source_stamp(filepath)
+    return all(metadata.get(k) == v for k, v in stamp.items())
+
+
+def parse_flow_csv(filepath):
+    """Typed columns of a flow CSV: categorical code_station, int64 epoch ns date, float32 debit"""
+    df = pd.read_csv(filepath, sep=',', dtype={'code_station': 'category', 'debit': np.float32})
+    df['date'] = pd.to_datetime(df['date']).values.view(np.int64)
     return df
 
 
-@st.cache
-def get_qi(filepath):
-    df = pd.read_csv(filepath, sep=',')
-    df['date'] = pd.to_datetime(df['date']).apply(lambda x: datetime.fromtimestamp(mktime(x.timetuple())))
-    df["date"] = df["date"].apply(utc.localize)
-    df["date"] = df["date"].dt.tz_convert('Europe/Paris')
+def build_flow_cache(filepath, cache_path=None):
+    """Convert a flow CSV into a typed, uncompressed Feather file.
+
+    Columns are code_station (dictionary encoded), date (int64 nanoseconds since
+    epoch of the naive CSV times) and debit (float32). The size and mtime of the
+    CSV are kept in the schema metadata to detect when the cache is stale.
+    """
+    cache_path = cache_path or flow_cache_path(filepath)
+    df = parse_flow_csv(filepath)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **_source_stamp(filepath)})
+
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    feather.write_feather(table, tmp_path, compression='uncompressed')
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def read_flows(filepath):
+    """Typed columns of a flow CSV, memory-mapped from its Feather cache (rebuilt if stale)"""
+    cache_path = flow_cache_path(filepath)
+    if not flow_cache_is_fresh(filepath, cache_path):
+        build_flow_cache(filepath, cache_path)
+    table = feather.read_table(cache_path, memory_map=True)
+    return table.to_pandas(split_blocks=True)
+
+
+def to_local_time(epoch_ns, tz='Europe/Paris'):
+    """Convert UTC epoch nanoseconds to tz-aware timestamps in one vectorized pass.
+
+    The Qi CSVs hold naive UTC times. Unlike a per-row mktime round trip, the
+    result doesn't depend on the server timezone and is exact across DST changes.
+    """
+    return pd.to_datetime(np.asarray(epoch_ns, dtype=np.int64), utc=True).tz_convert(tz)
+
+
+def _read_only(frame):
+    # Arrays of rows shared by all sessions: writing to them in place raises instead of altering them
+    for _, column in frame.items():
+        # The ndarray of the column, or those an extension array writes to: the codes of a Categorical, the
+        # datetime64 of a DatetimeArray with tz (_data in pandas 1.1, _ndarray later)
+        arrays = [column.values] + [getattr(column.array, name, None) for name in ('_codes', '_data', '_ndarray')]
+        for values in arrays:
+            # Up to the array of the block the column is a view of
+            while isinstance(values, np.ndarray):
+                values.flags.writeable = False
+                values = values.base
+    return frame
+
+
+def _rows_digest(previous, rows):
+    # previous (e.g. a version) chained with the content of the rows, whatever the categories of code_station
+    return hashlib.sha1(previous.encode() + pd.util.hash_pandas_object(rows, index=False).values.tobytes()).hexdigest()[:16]
+
+
+def _concat_flows(a, b):
+    # Keeps code_station categorical when the two frames have different stations, with sorted categories as when read
+    stations = union_categoricals([a['code_station'].astype('category'), b['code_station'].astype('category')],
+                                  sort_categories=True)
+    df = pd.concat([a.drop(columns='code_station'), b.drop(columns='code_station')], ignore_index=True)
+    df.insert(0, 'code_station', stations)
     return df
 
 
+def pivot_flows(data, daily=False):
+    """Date-indexed float32 (date x station) matrix of the flows.
+
+    Duplicated dates of a station keep their first value, like process_stations.
+    With daily, the index holds datetime.date, as the days picked in the app.
+    """
+    data = data.drop_duplicates(['code_station', 'date'], keep='first')
+    wide = data.pivot(index='date', columns='code_station', values='debit').astype(np.float32)
+    wide.columns = pd.Index(wide.columns.astype(str), name=None)
+    if daily:
+        wide.index = pd.Index(wide.index.date, name='date')
+    return wide
+
+
+def append_to_matrix(matrix, data, daily=False):
+    """New matrix with the flows of data added, without pivoting the existing rows again"""
+    new = pivot_flows(data, daily)
+    matrix = matrix.reindex(index=matrix.index.union(new.index), columns=matrix.columns.union(new.columns))
+    for station in new.columns:
+        values = new[station].dropna()
+        matrix.loc[values.index, station] = values.values
+    return matrix
+
+
+class StationIndex:
+    """Rows of a flow dataset sorted by station then date, with per-station offsets.
+
+    Rows of a station are the contiguous slice offsets[i]:offsets[i+1], so that
+    selecting stations and a date window is a binary search per station instead
+    of a boolean mask over the whole dataset.
+    """
+
+    def __init__(self, data):
+        dates = _epoch_ns(data['date'])
+        codes, stations = pd.factorize(data['code_station'], sort=True)
+        order = np.lexsort((dates, codes))
+        self.data = data.iloc[order].reset_index(drop=True)
+        self.dates = dates[order]
+        self.tz = getattr(data['date'].dtype, 'tz', None)
+        self.stations = pd.Index(np.asarray(stations, dtype=str))
+        self.offsets = np.r_[0, np.cumsum(np.bincount(codes, minlength=len(stations)))]
+
+    @property
+    def nbytes(self):
+        return _nbytes(self.data) + self.dates.nbytes + self.offsets.nbytes
+
+    def appended(self, data):
+        """New index with the rows of data added.
+
+        When the new rows of each station are later than its last ones (as
+        ingested by FlowStore), only the new rows are sorted: the existing ones
+        are moved in one take, without sorting them again.
+        """
+        new = StationIndex(data)
+        stations = self.stations.union(new.stations)
+        old_at, new_at = stations.get_indexer(self.stations), stations.get_indexer(new.stations)
+        old_counts, new_counts = np.zeros(len(stations), dtype=np.int64), np.zeros(len(stations), dtype=np.int64)
+        old_counts[old_at], new_counts[new_at] = np.diff(self.offsets), np.diff(new.offsets)
+
+        last = np.full(len(stations), np.iinfo(np.int64).min)
+        last[old_at[old_counts[old_at] > 0]] = self.dates[self.offsets[1:][old_counts[old_at] > 0] - 1]
+        first = new.dates[new.offsets[:-1][new_counts[new_at] > 0]]
+        if (first <= last[new_at[new_counts[new_at] > 0]]).any():
+            return StationIndex(_concat_flows(self.data, data))
+
+        offsets = np.r_[0, np.cumsum(old_counts + new_counts)]
+        # Destination of each row: start of its station, plus its rank within the station
+        old_dest = np.repeat(offsets[:-1][old_at] - self.offsets[:-1], old_counts[old_at]) + np.arange(len(self.dates))
+        new_dest = np.repeat(offsets[:-1][new_at] + old_counts[new_at] - new.offsets[:-1], new_counts[new_at]) + np.arange(len(new.dates))
+        take = np.empty(len(old_dest) + len(new_dest), dtype=np.int64)
+        take[old_dest] = np.arange(len(old_dest))
+        take[new_dest] = len(old_dest) + np.arange(len(new_dest))
+
+        index = StationIndex.__new__(StationIndex)
+        index.data = _concat_flows(self.data, new.data).iloc[take].reset_index(drop=True)
+        index.dates = np.concatenate([self.dates, new.dates])[take]
+        index.tz = self.tz
+        index.stations = stations
+        index.offsets = offsets
+        return index
+
+    def rows(self, stations, date_range=None):
+        """Positions of the rows of stations within date_range (first and last day included)"""
+        if date_range is not None:
+            start, end = _day_bounds(date_range, self.tz)
+        parts = []
+        for station in stations:
+            if station not in self.stations:
+                continue
+            i = self.stations.get_loc(station)
+            lo, hi = self.offsets[i], self.offsets[i+1]
+            if date_range is not None:
+                lo, hi = lo + np.searchsorted(self.dates[lo:hi], [start, end])
+            parts.append(np.arange(lo, hi))
+        return np.concatenate(parts) if parts else np.array([], dtype=np.int64)
+
+    def select(self, stations, date_range=None):
+        return self.data.iloc[self.rows(stations, date_range)]
+
+
+# Aggregated levels of the Qi pyramid, from the finest to the coarsest. The
+# 15 min base level is the raw data itself.
+DAY_NS = 24 * 3600 * 10**9
+PYRAMID_STEPS = OrderedDict([
+    ('1H', 3600 * 10**9),
+    ('1D', DAY_NS),
+    ('7D', 7 * DAY_NS),
+])
+# Monday 1970-01-05, where the buckets of several days start
+BUCKET_ANCHOR = pd.Timestamp('1970-01-05')
+
+
+def bucket_starts(dates, step, tz=None):
+    """Epoch nanoseconds of the start of the step-long bucket of each of dates (epoch nanoseconds).
+
+    Buckets of whole days are cut on the days of tz, weeks from Monday;
+    shorter ones on the epoch, like the Qi times.
+    """
+    anchor = BUCKET_ANCHOR.value
+    if tz is None or step % DAY_NS:
+        return dates - (dates - anchor) % step
+    local = pd.DatetimeIndex(dates).tz_localize('UTC').tz_convert(tz).tz_localize(None).asi8
+    starts, inverse = np.unique(local - (local - anchor) % step, return_inverse=True)
+    # Local midnights, as epoch nanoseconds
+    starts = pd.DatetimeIndex(starts).tz_localize(tz, ambiguous='NaT', nonexistent='shift_forward').asi8
+    return starts[inverse]
+
+
+def aggregate_flows(data, step, tz=None):
+    """Sum, count, min and max of the flows per station and step-long bucket.
+
+    Sums and counts rather than means, so that aggregates of new rows can be
+    merged into existing ones. Rows are sorted by station then bucket. Buckets
+    of whole days are local days of tz, see bucket_starts.
+    """
+    flows = data['debit'].values
+    valid = ~np.isnan(flows)
+    dates = _epoch_ns(data['date'])[valid]
+    df = pd.DataFrame({
+        'code_station': np.asarray(data['code_station'], dtype=str)[valid],
+        'bucket': bucket_starts(dates, step, tz),
+        'debit': flows[valid].astype(np.float64),
+    })
+    return _regroup(df.groupby(['code_station', 'bucket'], sort=True)['debit'].agg(['sum', 'count', 'min', 'max']))
+
+
+def _regroup(aggregates):
+    # Sums stay float64 for exact merges, the rest is as compact as the raw rows
+    return aggregates.reset_index().astype({'code_station': 'category', 'count': np.int32, 'min': np.float32, 'max': np.float32})
+
+
+def merge_aggregates(level, partial):
+    """Merge the aggregates of new rows into a level, re-grouping only the buckets they touch"""
+    if len(partial) == 0:
+        return level
+    # Stations as strings while merging, as the two levels may not have the same categories
+    level, partial = level.astype({'code_station': str}), partial.astype({'code_station': str})
+    first_new = partial.groupby('code_station')['bucket'].min()
+    touched = level['bucket'].values >= level['code_station'].map(first_new).fillna(np.inf).values
+    tail = pd.concat([level[touched], partial]).groupby(['code_station', 'bucket'], sort=True).agg(
+        {'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max'})
+    merged = pd.concat([level[~touched], _regroup(tail).astype({'code_station': str})], ignore_index=True)
+    return merged.sort_values(['code_station', 'bucket'], kind='mergesort', ignore_index=True).astype({'code_station': 'category'})
+
+
+class FlowPyramid:
+    """Qi flows at 15 min, hourly, daily and weekly resolution, with mean/min/max per bucket.
+
+    The 15 min level is the StationIndex of the raw rows given at creation.
+    """
+
+    def __init__(self, base, steps=PYRAMID_STEPS, levels=None):
+        self.base = base
+        self.tz = base.tz
+        self.steps = steps
+        self.levels = levels or {name: aggregate_flows(base.data, step, self.tz) for name, step in steps.items()}
+        self._indexes = {}
+
+    @property
+    def nbytes(self):
+        return sum(_nbytes(level) for level in self.levels.values())
+
+    def appended(self, data, base):
+        """New pyramid over base, the raw index with the rows of data already added.
+
+        Only the aggregates of the new rows are computed and merged into each level.
+        """
+        levels = {name: merge_aggregates(self.levels[name], aggregate_flows(data, step, self.tz)) for name, step in self.steps.items()}
+        return FlowPyramid(base, self.steps, levels)
+
+    def level_for(self, date_range, width=CHART_WIDTH_PX):
+        """Coarsest level that still gives at least one point per pixel over date_range"""
+        start, end = _day_bounds(date_range, self.tz)
+        best = None
+        for name, step in self.steps.items():
+            if (end - start) // step >= width:
+                best = name
+        return best
+
+    def index(self, name):
+        # StationIndex of a level, laid out like the raw data for the chart
+        if name is None:
+            return self.base
+        if name not in self._indexes:
+            level = self.levels[name]
+            self._indexes[name] = StationIndex(pd.DataFrame({
+                'code_station': level['code_station'],
+                'date': to_local_time(level['bucket'].values, self.tz) if self.tz is not None else level['bucket'].values,
+                'debit': (level['sum'] / level['count']).astype(np.float32),
+                'debit_min': level['min'].astype(np.float32),
+                'debit_max': level['max'].astype(np.float32),
+            }))
+        return self._indexes[name]
+
+    def select(self, stations, date_range, width=CHART_WIDTH_PX):
+        name = self.level_for(date_range, width)
+        if name is not None:
+            ## The bucket of the first day may start before it, e.g. a week on the Monday before
+            first = pd.Timestamp(date_range[0])
+            days = self.steps[name] // DAY_NS
+            if days > 1:
+                date_range = (first - timedelta((first - BUCKET_ANCHOR).days % days), date_range[1])
+        return self.index(name).select(stations, date_range)
+
+
+class FlowStore:
+    """Flow dataset that grows with the CSV files dropped in its incoming directory.
+
+    Files of INCOMING_DIR/<name of the base CSV>/ have the same columns as the
+    base CSV. Each one is read when it appears or changes, and only its rows
+    later than the last ingested date of their station are kept. A file that
+    cannot be parsed is logged and skipped until it changes. Rows read from a
+    half-written file would hide the complete ones, so only *.csv files are
+    read: write a file as e.g. <name>.csv.tmp, then rename it. The long
+    frame, the wide matrix, the StationIndex and the pyramid are then extended
+    with these rows only, rather than rebuilt from the whole history. Derived
+    structures are built on first use and replaced, never mutated, so readers
+    can keep the ones they hold.
+
+    Rows are kept once, sorted by station then date in the StationIndex, with
+    a categorical code_station, a float32 debit and a datetime64 date (naive
+    days for Qmj, in tz for Qi, int64 UTC nanoseconds if tz is None). Their
+    arrays are read-only, so sessions use them without copying them.
+
+    version identifies the rows, in any process: a hash of the base rows,
+    chained with those of each ingested batch. changes lists the version
+    after each batch with the first day of its rows, so that what is derived
+    from the days before can be kept.
+    """
+
+    def __init__(self, filepath, tz=None, daily=False):
+        self.filepath = filepath
+        self.tz = tz
+        self.daily = daily
+        self.incoming = os.path.join(INCOMING_DIR, os.path.splitext(os.path.basename(filepath))[0])
+        self.mtime = os.path.getmtime(filepath)
+        self.changes = []
+        self._lock = threading.RLock()
+        self._seen = {}
+        self._checked = None
+        self._matrix = self._pyramid = None
+
+        rows = read_flows(filepath)
+        # The same rows presented differently are different data
+        self.base_version = _rows_digest(repr((tz, daily)), rows)
+        self.last = rows.groupby(np.asarray(rows['code_station'], dtype=str))['date'].max()
+        self._index = self._indexed(self._present(rows))
+        self.refresh()
+
+    @property
+    def version(self):
+        return self.changes[-1][0] if self.changes else self.base_version
+
+    def changed_since(self, version):
+        """First day of the rows ingested after version, None if version isn't an earlier one of this store"""
+        return _changed_since(self.base_version, self.changes, version)
+
+    def snapshot(self):
+        """FlowData of the current version, e.g. for the sources of a run"""
+        with self._lock:
+            return FlowData(self, self.version, self._index, self.matrix, self.base_version, tuple(self.changes))
+
+    def pyramid_of(self, index):
+        # The pyramid of the store if index is still its own, else one of index alone
+        with self._lock:
+            if index is self._index:
+                return self.pyramid
+        return FlowPyramid(index)
+
+    @property
+    def nbytes(self):
+        derived = [x for x in (self._matrix, self._pyramid) if x is not None]
+        return _nbytes(self._index) + sum(_nbytes(x) for x in derived)
+
+    def _present(self, rows):
+        # Qmj dates as naive datetime64 days, Qi dates in tz or kept as int64 nanoseconds if tz is None
+        rows = rows.copy(deep=False)
+        if self.daily:
+            rows['date'] = rows['date'].values.view('datetime64[ns]')
+        elif self.tz is not None:
+            rows['date'] = to_local_time(rows['date'].values, self.tz)
+        return rows
+
+    def _indexed(self, rows, index=None):
+        # StationIndex of rows, or index with rows added, with read-only arrays
+        index = StationIndex(rows) if index is None else index.appended(rows)
+        _read_only(index.data)
+        return index
+
+    @property
+    def data(self):
+        return self._index.data
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def matrix(self):
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = pivot_flows(self.data, self.daily)
+            return self._matrix
+
+    @property
+    def pyramid(self):
+        with self._lock:
+            if self._pyramid is None:
+                self._pyramid = FlowPyramid(self.index)
+            return self._pyramid
+
+    def refresh(self, interval=0):
+        """Ingest the new or changed files of the incoming directory, at most every interval seconds"""
+        now = tt.monotonic()
+        with self._lock:
+            if self._checked is not None and now - self._checked < interval:
+                return
+            self._checked = now
+            if not os.path.isdir(self.incoming):
+                return
+            for entry in sorted(os.scandir(self.incoming), key=lambda e: e.name):
+                if not entry.name.endswith('.csv'):
+                    continue
+                stamp = (entry.stat().st_mtime_ns, entry.stat().st_size)
+                if self._seen.get(entry.path) != stamp:
+                    self._seen[entry.path] = stamp
+                    try:
+                        rows = parse_flow_csv(entry.path)[['code_station', 'date', 'debit']]
+                    except (OSError, ValueError, KeyError) as e:
+                        ingest_log.warning('%s skipped: %r', entry.path, e)
+                        continue
+                    self.ingest(rows)
+
+    def ingest(self, rows):
+        """Add the rows of a parsed flow CSV that are later than the last ones of their station"""
+        with self._lock:
+            at = self.last.index.get_indexer(np.asarray(rows['code_station'], dtype=str))
+            last = np.where(at >= 0, self.last.values[at], np.iinfo(np.int64).min)
+            rows = rows[rows['date'].values > last]
+            rows = rows.drop_duplicates(['code_station', 'date'], keep='first')
+            if len(rows) == 0:
+                return 0
+
+            new_last = rows.groupby(np.asarray(rows['code_station'], dtype=str))['date'].max()
+            self.last = pd.concat([self.last, new_last]).groupby(level=0).max()
+            # Day of the naive CSV times, for Qi the local one or the day before
+            self.changes.append((_rows_digest(self.version, rows), pd.Timestamp(rows['date'].min()).date()))
+            rows = self._present(rows)
+            self._index = self._indexed(rows, self._index)
+            if self._matrix is not None:
+                self._matrix = append_to_matrix(self._matrix, rows, self.daily)
+            if self._pyramid is not None:
+                self._pyramid = self._pyramid.appended(rows, self._index)
+            return len(rows)
+
+
+def _changed_since(base_version, changes, version):
+    versions = [base_version] + [v for v, _ in changes]
+    if version not in versions[:-1]:
+        return None
+    return min(day for _, day in changes[versions.index(version):])
+
+
+class FlowData:
+    """Rows of a FlowStore and what is derived from them, as of one of its versions.
+
+    This is what a run reads: the store may ingest new rows meanwhile, but
+    version, index, matrix and pyramid keep describing the same rows.
+    """
+
+    def __init__(self, store, version, index, matrix, base_version, changes):
+        self._store = store
+        self.filepath = store.filepath
+        self.version = version
+        self.index = index
+        self.matrix = matrix
+        self.base_version = base_version
+        self.changes = changes
+
+    @property
+    def data(self):
+        return self.index.data
+
+    @property
+    def pyramid(self):
+        return self._store.pyramid_of(self.index)
+
+    def changed_since(self, version):
+        """First day of the rows ingested after version, None if version isn't an earlier one of the store"""
+        return _changed_since(self.base_version, self.changes, version)
+
+    def version_until(self, day):
+        """Version of the rows up to day: the one after the last batch with rows on or before day"""
+        version = self.base_version
+        for batch_version, first in self.changes:
+            if first <= day:
+                version = batch_version
+        return version
+
+
+_flow_cache = FileCache(FLOW_CACHE_MAX_BYTES)
+
+
+def get_store(filepath, tz=None, daily=False):
+    store = _flow_cache.get(filepath, lambda path: FlowStore(path, tz, daily), key=(filepath, tz, daily))
+    store.refresh(INGEST_INTERVAL)
+    return store
+
+
+def get_qmj(filepath):
+    return get_store(filepath, daily=True).data
+
+
+def get_qi(filepath, tz='Europe/Paris'):
+    # With tz=None, dates stay int64 UTC nanoseconds until to_local_time at display
+    return get_store(filepath, tz).data
+
+
+def get_qmj_matrix(filepath):
+    return get_store(filepath, daily=True).matrix
+
+
+def get_qi_matrix(filepath):
+    return get_store(filepath, 'Europe/Paris').matrix
+
+
+def get_qmj_index(filepath):
+    return get_store(filepath, daily=True).index
+
+
+def get_qmj_version(filepath):
+    return get_store(filepath, daily=True).version
+
+
+def get_qi_version(filepath, tz='Europe/Paris'):
+    return get_store(filepath, tz).version
+
+
+def get_qi_pyramid(filepath):
+    return get_store(filepath, 'Europe/Paris').pyramid
+
+
+def load_qmj(filepath):
+    # The matrix is built here too, as the first run needs it anyway
+    return get_store(filepath, daily=True).snapshot()
+
+
+def load_qi(filepath, tz='Europe/Paris'):
+    return get_store(filepath, tz).snapshot()
+
+
+# Sources of the app: name -> (path, loader), each loader going through its process cache
+DATA_SOURCES = OrderedDict([
+    ('ug', ('data/ss-unites-gestion.geojson', get_layer)),
+    ('hydro', ('data/hydrographie.geojson', get_layer)),
+    ('stations', ('data/stations.geojson', get_layer)),
+    ('qmj', ('data/hbv_qmj.csv', load_qmj)),
+    ('qi', ('data/hbv_qi.csv', load_qi)),
+])
+
+
+def source_version(value):
+    """(filepath, hash of the file) of a GeoLayer, the hash of the rows of a FlowData"""
+    if isinstance(value, FlowData):
+        return value.version
+    return (value.filepath, value.version)
+
+
+class DataBundle(namedtuple('DataBundle', list(DATA_SOURCES) + ['errors', 'timings', 'version'])):
+    """Sources of one run, as loaded together by load_sources().
+
+    A source that failed to load is None, and its exception is in errors, by
+    name. timings are the seconds each source took to load. Flows are FlowData, which keep the rows they were loaded with even
+    if their store ingests new ones during the run. version hashes the
+    versions of the loaded sources: it changes when a file changes or new
+    flows are ingested.
+    """
+    __slots__ = ()
+
+
+_load_pool = None
+_load_pool_lock = threading.Lock()
+
+
+def _pool():
+    global _load_pool
+    with _load_pool_lock:
+        if _load_pool is None:
+            _load_pool = ThreadPoolExecutor(max_workers=LOAD_WORKERS, thread_name_prefix='lvdlr-load')
+        return _load_pool
+
+
+def _load_source(path, load):
+    start = tt.perf_counter()
+    try:
+        return load(path), None, tt.perf_counter() - start
+    except Exception as error:
+        return None, error, tt.perf_counter() - start
+
+
+def load_sources(parallel=LOAD_WORKERS > 0):
+    """Load every source of DATA_SOURCES, concurrently if parallel.
+
+    Sources are read in threads: Feather reads and pivots mostly release the
+    GIL, and the layers are read meanwhile. Sources are read once per process
+    and file version by their caches, so on reruns this only checks their
+    modification times and takes a snapshot of the flow stores.
+
+    The time of each source is also recorded as the stage 'load <name>' of
+    the current run: these overlap, and are part of the 'load' stage.
+    """
+    if parallel:
+        futures = [(name, _pool().submit(_load_source, path, load)) for name, (path, load) in DATA_SOURCES.items()]
+        results = OrderedDict((name, future.result()) for name, future in futures)
+    else:
+        results = OrderedDict((name, _load_source(path, load)) for name, (path, load) in DATA_SOURCES.items())
+
+    values = {name: value for name, (value, _, _) in results.items()}
+    errors = MappingProxyType({name: error for name, (_, error, _) in results.items() if error is not None})
+    timings = MappingProxyType(OrderedDict((name, seconds) for name, (_, _, seconds) in results.items()))
+    for name, seconds in timings.items():
+        record_stage(f'load {name}', seconds)
+    versions = [(name, source_version(value)) for name, value in values.items() if value is not None]
+    version = hashlib.sha1(repr(versions).encode()).hexdigest()[:16]
+    return DataBundle(errors=errors, timings=timings, version=version, **values)
+
+
+def filter_flows(data, flow_range):
+    """Drop the rows with a flow out of flow_range, except those next to a row within it.
+
+    data must be sorted by station then date, like StationIndex.select output.
+    The kept neighbours let lines leave and re-enter a clipped chart as before.
+    """
+    flows = data['debit'].values
+    inside = (flows >= flow_range[0]) & (flows <= flow_range[1])
+    same_station = data['code_station'].values[1:] == data['code_station'].values[:-1]
+    keep = inside.copy()
+    keep[1:] |= inside[:-1] & same_station
+    keep[:-1] |= inside[1:] & same_station
+    return data[keep]
+
+
+def _epoch_ns(dates):
+    # datetime.date, naive or tz-aware dates to int64 UTC nanoseconds
+    if dates.dtype == np.int64:
+        return dates.values
+    dates = pd.to_datetime(dates)
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_convert('UTC')
+    return dates.values.view(np.int64)
+
+
+def _day_bounds(date_range, tz=None):
+    # Epoch nanoseconds of the start of the first day and the end of the last one
+    start, end = pd.Timestamp(date_range[0]), pd.Timestamp(date_range[1]) + timedelta(1)
+    if tz is not None:
+        start, end = start.tz_localize(tz), end.tz_localize(tz)
+    return start.value, end.value
+
+
+def downsample(data, width=CHART_WIDTH_PX, date_range=None):
+    """Min/max downsampling of the flows of each station for a chart width pixels wide.
+
+    The date_range window (or the whole span) is split in width buckets per
+    station, and each bucket keeps only the rows of its lowest and highest flow:
+    at most 2*width points per station, with peaks and troughs (and thus
+    threshold crossings) kept. Rows of an aggregated level of the pyramid also
+    get the lowest debit_min and highest debit_max of their bucket, so that
+    the band keeps the troughs and peaks of the rows left out. Rows keep their
+    original order. data is expected to be already restricted to date_range,
+    e.g. by StationIndex.select.
+    """
+    keep = ~np.isnan(data['debit'].values)
+    data = data[keep]
+    dates = _epoch_ns(data['date'])
+    stations = pd.factorize(data['code_station'])[0]
+    if len(data) == 0 or np.bincount(stations).max() <= 2 * width:
+        return data
+
+    if date_range is not None:
+        start, end = _day_bounds(date_range, getattr(data['date'].dtype, 'tz', None))
+    else:
+        start, end = dates.min(), dates.max() + 1
+    buckets = ((dates - start) * width // max(end - start, 1)).clip(0, width - 1)
+    keys = stations * width + buckets
+    # Sorted by bucket then flow: the first row of a bucket is its min, the last its max
+    order = np.lexsort((data['debit'].values, keys))
+    sorted_keys = keys[order]
+    firsts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    lasts = np.r_[firsts[1:], len(order)] - 1
+    rows, at = np.unique(np.r_[order[firsts], order[lasts]], return_index=True)
+    sampled = data.iloc[rows]
+    if 'debit_min' in data.columns:
+        # Bucket of each kept row, the first and last rows of a bucket being picked in the same order
+        bucket = np.r_[np.arange(len(firsts)), np.arange(len(firsts))][at]
+        sampled = sampled.assign(
+            debit_min=np.minimum.reduceat(data['debit_min'].values[order], firsts)[bucket],
+            debit_max=np.maximum.reduceat(data['debit_max'].values[order], firsts)[bucket],
+        )
+    return sampled
+
+
+def flow_band(data, color):
+    # Min/max band of aggregated flows, as a list of layers to unpack (empty for raw data)
+    if 'debit_min' not in data.columns:
+        return []
+    return [alt.Chart().mark_area(opacity=0.2, clip=True).encode(
+        x='date:T',
+        y='debit_min:Q',
+        y2='debit_max:Q',
+        color=color
+    )]
+
 
 def process_stations(station, data):
     subset_data = data[['date','debit']][data['code_station']==station].set_index('date')
@@ -68,6 +1351,257 @@ def get_ug_status(id_ug, map_hydro_status, map_hydro_ug):
     return map_hydro_status.loc[map_hydro_ug==id_ug].max()
 
 
+def classify_flows(flows, thresholds):
+    """Status codes of get_station_status for a whole (stations x days) flow matrix.
+
+    thresholds is a (stations x 4) array of DOE, DA, DAR and DC. Stations without
+    flow or thresholds get 0, as today.
+    """
+    flows = np.asarray(flows, dtype=float)
+    thresholds = np.asarray(thresholds, dtype=float)
+    doe, da, dar, dcr = (thresholds[:, [k]] for k in range(4))
+
+    # With ordered thresholds, the status is 1 + the number of thresholds the flow
+    # is under, i.e. a searchsorted of the flow into its station's thresholds
+    ordered = np.all(np.isfinite(thresholds), axis=1) & np.all(np.diff(thresholds, axis=1) <= 0, axis=1)
+    with np.errstate(invalid='ignore'):
+        below = (flows[:, :, None] < thresholds[:, None, :]).sum(axis=2)
+        status = np.where(np.isnan(flows), 0, 1 + below)
+
+        # Otherwise, replay the cascade of get_station_status as is
+        if not ordered.all():
+            cascade = np.select(
+                [flows >= doe, (flows < doe) & (flows >= da), (flows < da) & (flows >= dar), (flows < dar) & (flows >= dcr), flows < dcr],
+                [1, 2, 3, 4, 5],
+                0
+            )
+            status = np.where(ordered[:, None], status, cascade)
+    return status.astype(np.int8)
+
+
+class GroupIndex:
+    """CSR membership of items (e.g. stations) into groups (e.g. reaches).
+
+    The members of group g are indices[indptr[g]:indptr[g+1]], as positions of
+    the items, so that a max per group is a single np.maximum.reduceat instead
+    of one boolean mask per group.
+    """
+
+    def __init__(self, indptr, indices):
+        self.indptr = np.asarray(indptr, dtype=np.intp)
+        self.indices = np.asarray(indices, dtype=np.intp)
+        self.size = len(self.indptr) - 1
+
+    @classmethod
+    def from_codes(cls, codes, size):
+        """Groups given the group position of each item, -1 for none"""
+        codes = np.asarray(codes)
+        members = np.flatnonzero(codes >= 0)
+        indices = members[np.argsort(codes[members], kind='stable')]
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(codes[members], minlength=size))])
+        return cls(indptr, indices)
+
+    @classmethod
+    def from_members(cls, members, item_keys):
+        """Groups given as lists of item keys, kept in item order. Unknown keys are left out."""
+        item_keys = pd.Index(item_keys)
+        positions = [np.sort(p[p >= 0]) for p in (item_keys.get_indexer(list(m)) for m in members)]
+        indptr = np.concatenate([[0], np.cumsum([len(p) for p in positions])])
+        return cls(indptr, np.concatenate(positions) if positions else [])
+
+    def members(self, group):
+        return self.indices[self.indptr[group]:self.indptr[group + 1]]
+
+    def max(self, values):
+        # -1 for groups without members, like the NaN of get_hydro_status/get_ug_status
+        out = np.full((self.size,) + values.shape[1:], -1, dtype=values.dtype)
+        nonempty = np.flatnonzero(np.diff(self.indptr))
+        if len(nonempty):
+            out[nonempty] = np.maximum.reduceat(values[self.indices], self.indptr[nonempty], axis=0)
+        return out
+
+
+# Stations along each river, from upstream to downstream, for the river chart
+RIVERS = OrderedDict([
+    ('Lot amont', ['O7001510','O7021530','O7041510','O7101510','O7161510_E','O7191510']),
+    ('Colagne', ['O7054010','O7074020','O7094010']),
+    ('Lot domanial', ['O7701540','O7971510','O8231530','COUTET','O8661520']),
+    ('Célé', ['O8113520','O8133520']),
+])
+
+
+class TopologyIndex:
+    """Station -> reach -> management unit joins and river -> stations, built once from the layers.
+
+    Joins are positions in the layer tables (-1 when there is none) and each
+    membership is a GroupIndex, so roll-ups are linear in features instead of
+    one scan of the layer per feature.
+    """
+
+    def __init__(self, map_stations, map_hydro, map_ug, rivers=RIVERS):
+        self.stations = pd.Index(map_stations['COD_STAT'])
+        self.station_reach = pd.Index(map_hydro['ID_hydrographie']).get_indexer(map_stations['ID_hydrographie'])
+        self.reach_unit = pd.Index(map_ug['ID_ss-unite-gestion']).get_indexer(map_hydro['ID_ss-unite-gestion'])
+        self.reach_stations = GroupIndex.from_codes(self.station_reach, len(map_hydro))
+        self.unit_reaches = GroupIndex.from_codes(self.reach_unit, len(map_ug))
+        self.river_names = list(rivers)
+        self.river_stations = GroupIndex.from_members(rivers.values(), self.stations)
+
+    def roll_up(self, station_status):
+        """Max status of the stations of each reach, and of the reaches of each unit"""
+        hydro_status = self.reach_stations.max(station_status)
+        return hydro_status, self.unit_reaches.max(hydro_status)
+
+    def rivers_frame(self, map_stations):
+        """Rows of map_stations along each river, as the concatenation of process_rivers for every river.
+
+        map_stations has the station codes in its 'index' column. The 'index'
+        of the result is the position of the station on its river.
+        """
+        rows = pd.Index(map_stations['index']).get_indexer(self.stations)
+        parts = [np.sort(r[r >= 0]) for r in (rows[self.river_stations.members(g)] for g in range(self.river_stations.size))]
+        take = np.concatenate(parts).astype(np.intp)
+        frame = map_stations.iloc[take].drop(columns={'geometry'}, errors='ignore').rename(columns={'index': 'COD_STAT'}).reset_index(drop=True)
+        frame['river_name'] = np.repeat(self.river_names, [len(p) for p in parts])
+        frame.insert(0, 'index', np.concatenate([np.arange(len(p)) for p in parts]).astype(np.int64))
+        return frame
+
+
+class StatusEngine:
+    """Vectorized station -> reach -> management unit status"""
+
+    def __init__(self, topology, map_stations, threshold_columns):
+        self.topology = topology
+        self.stations = topology.stations
+        self.thresholds = map_stations[threshold_columns].to_numpy(dtype=float)
+
+    def status(self, flows):
+        """Status of stations, reaches and units for a (stations x days) flow matrix"""
+        station_status = classify_flows(flows, self.thresholds)
+        hydro_status, ug_status = self.topology.roll_up(station_status)
+        return station_status, hydro_status, ug_status
+
+
+_topology = (None, None)
+_topology_lock = threading.Lock()
+
+
+def get_topology(stations_layer, hydro_layer, ug_layer):
+    # Rebuilt only when one of the layers is reloaded
+    global _topology
+    key = (stations_layer, hydro_layer, ug_layer)
+    with _topology_lock:
+        if _topology[0] != key:
+            _topology = (key, TopologyIndex(stations_layer.table, hydro_layer.table, ug_layer.table))
+        return _topology[1]
+
+
+_status_engine = (None, None)
+_status_engine_lock = threading.Lock()
+
+
+def get_status_engine(stations_layer, hydro_layer, ug_layer, threshold_columns):
+    # Rebuilt only when one of the layers is reloaded
+    global _status_engine
+    key = (stations_layer, hydro_layer, ug_layer, tuple(threshold_columns))
+    with _status_engine_lock:
+        if _status_engine[0] != key:
+            engine = StatusEngine(get_topology(stations_layer, hydro_layer, ug_layer), stations_layer.table, threshold_columns)
+            _status_engine = (key, engine)
+        return _status_engine[1]
+
+
+class StatusCube:
+    """Status of every station, reach and unit for every day of the Qmj history.
+
+    Arrays are int8 and indexed by (day - first day, feature), so that the
+    status of any window of days is a slice instead of a new classification.
+    Only the flows of the given stations are classified, the others get 0.
+
+    qmj is the FlowData of the Qmj, and inputs identifies the rest of what the
+    status is computed from (layers, thresholds, stations). version
+    identifies the whole cube. day_version(day) only identifies what the
+    status of the days up to day is drawn from, e.g. for the keys of the
+    states of a day: unlike version, it doesn't change when rows of later
+    days are ingested.
+    """
+
+    def __init__(self, qmj, engine, stations, inputs=None, levels=None):
+        matrix = qmj.matrix
+        days = pd.date_range(min(matrix.index), max(matrix.index), freq='D').date
+        self.qmj = qmj
+        self.inputs = inputs
+        self.version = (qmj.version, inputs)
+        self.engine = engine
+        self.stations = stations
+        self.station_codes = engine.stations
+        self.first = days[0]
+        self.days = days
+        self.levels = levels or self._classify(matrix, days)
+        self.missing = tuple(x[:, 0] for x in engine.status(np.full((len(engine.stations), 1), np.nan)))
+
+    def _classify(self, matrix, days):
+        # (days x features) status of stations, reaches and units on days
+        flows = matrix.reindex(index=days, columns=self.engine.stations).to_numpy(dtype=float)
+        flows[:, ~self.engine.stations.isin(self.stations)] = np.nan
+        # Rounded like the Qmj displayed on the map, which the status was computed from
+        return tuple(x.T.copy() for x in self.engine.status(np.round(flows, 4).T))
+
+    def appended(self, qmj, since):
+        """Cube of qmj, the same Qmj with new rows from the day since on, classifying only the days from since"""
+        days = pd.date_range(min(qmj.matrix.index), max(qmj.matrix.index), freq='D').date
+        kept = min((since - self.first).days, len(self.days))
+        if days[0] != self.first or kept <= 0:
+            return StatusCube(qmj, self.engine, self.stations, self.inputs)
+        new = self._classify(qmj.matrix, days[kept:])
+        levels = tuple(np.concatenate([level[:kept], x]) for level, x in zip(self.levels, new))
+        return StatusCube(qmj, self.engine, self.stations, self.inputs, levels)
+
+    def day_version(self, day):
+        return (self.qmj.version_until(day), self.inputs)
+
+    @property
+    def nbytes(self):
+        return sum(x.nbytes for x in self.levels)
+
+    def window(self, day, days=7):
+        """(features x days) status of stations, reaches and units for day, day-1, ..., day-days+1"""
+        positions = (day - self.first).days - np.arange(days)
+        valid = (positions >= 0) & (positions < len(self.days))
+        positions = positions.clip(0, len(self.days) - 1)
+        return tuple(np.where(valid, level[positions].T, missing[:, None]) for level, missing in zip(self.levels, self.missing))
+
+
+def status_history(status, stations, dates):
+    """Long (stations, day, status) frame of a (stations x days) status array, e.g. for the heatmap"""
+    frame = pd.DataFrame(status, index=pd.Index(stations, name='stations'), columns=pd.Index(dates, name='day'))
+    return frame.stack().rename('status').reset_index()
+
+
+_status_cube = (None, None)
+_status_cube_lock = threading.Lock()
+
+
+def get_status_cube(qmj, stations_layer, hydro_layer, ug_layer, threshold_columns, stations):
+    # Of qmj, the FlowData of the Qmj of a run. Recomputed when a layer is reloaded, and only from the first new day when
+    # the Qmj store gets new rows
+    global _status_cube
+    engine = get_status_engine(stations_layer, hydro_layer, ug_layer, threshold_columns)
+    key = (qmj.version, engine, tuple(stations))
+    with _status_cube_lock:
+        previous_key, cube = _status_cube
+        if previous_key != key:
+            layers = tuple((layer.filepath, layer.version) for layer in (stations_layer, hydro_layer, ug_layer))
+            inputs = (layers, tuple(threshold_columns), tuple(stations))
+            since = None if cube is None or previous_key[1:] != key[1:] else qmj.changed_since(previous_key[0])
+            if since is not None:
+                cube = cube.appended(qmj, since)
+            else:
+                cube = StatusCube(qmj, engine, stations, inputs)
+            _status_cube = (key, cube)
+        return _status_cube[1]
+
+
 def get_status_color(status, t=None):
     if status == 1:
         rgb = [136, 206, 51]
@@ -91,6 +1625,243 @@ def get_status_color(status, t=None):
     return rgb
 
 
+# Layer types of get_status_color, in the order of the first axis of STATUS_PALETTE
+LAYER_TYPES = (None, 'hydro', 'ug')
+NO_STATUS = 6
+
+
+def _build_status_palette():
+    palette = []
+    for t in LAYER_TYPES:
+        rows = [get_status_color(status, t) for status in range(0, NO_STATUS)] + [get_status_color(None, t)]
+        palette.append([rgb + [255] * (4 - len(rgb)) for rgb in rows])
+    # deck.gl clamps colours to 0-255 anyway, e.g. the -50 of 'hydro' on the status 5 black
+    return np.clip(np.array(palette), 0, 255).astype(np.uint8)
+
+
+# RGBA of get_status_color by (layer type, status code), the last status row being for no status
+STATUS_PALETTE = _build_status_palette()
+
+
+def status_colors(status, t=None):
+    """(n, 4) uint8 RGBA colours of the status codes for layer type t, in one lookup.
+
+    Anything but the codes 0 to 5 (-1, NaN) gets the colour of no status, as
+    with get_status_color.
+    """
+    status = np.asarray(status)
+    if status.dtype.kind != 'i':
+        status = np.where(np.isnan(status), -1, status).astype(int)
+    status = np.where((status >= 0) & (status < NO_STATUS), status, NO_STATUS)
+    return STATUS_PALETTE[LAYER_TYPES.index(t), status]
+
+
+def basin_state(stations_layer, qmj_matrix, status_cube, stations, date_qmj, selected_stations=None):
+    """Stations with their Qmj and status on the 7 days up to date_qmj, and the colours of the map.
+
+    Returns (qmj_window, map_stations, hydro_colors, ug_colors). map_stations
+    only keeps selected_stations if given.
+    """
+    ## Slice the qmj of the 7 days from the precomputed (date x station) matrix
+    qmj_window = qmj_matrix.reindex([date_qmj-timedelta(d) for d in range(0,7)]).astype(float).round(4)
+
+    ## Concat stations with their corresponding qmj
+    rename_col_dict = {date_qmj-timedelta(d): (date_qmj-timedelta(d)).strftime('%_d/%m/%Y') for d in range(0,7)}
+    map_stations = pd.concat([stations_layer.frame().set_index('COD_STAT'),qmj_window.reindex(columns=stations).T], axis=1).rename(columns=rename_col_dict)
+
+    ## Read the status from the status cube, for stations and rolled up to hydro and management units
+    station_status, hydro_status, ug_status = status_cube.window(date_qmj, 7)
+    for d, col in enumerate(rename_col_dict.values()):
+        map_stations[f"{col}-status"] = pd.Series(station_status[:, d], index=status_cube.station_codes)
+
+    ## Associate color to the status of the day, by a lookup in the palette of each layer type
+    ### Rivers and management units only get a (n, 4) RGBA buffer indexed by feature id
+    with substage('colouring'):
+        station_day_status = map_stations[f"{date_qmj.strftime('%_d/%m/%Y')}-status"]
+        map_stations['color'] = status_colors(station_day_status).tolist()
+        map_stations['color_stroke'] = status_colors(station_day_status, 'hydro').tolist()
+        hydro_colors = status_colors(hydro_status[:, 0], 'hydro')
+        ug_colors = status_colors(ug_status[:, 0], 'ug')
+
+    map_stations.reset_index(inplace=True)
+    if selected_stations is not None:
+        map_stations = map_stations.loc[map_stations['index'].isin(selected_stations)]
+    return qmj_window, map_stations, hydro_colors, ug_colors
+
+
+def threshold_state(map_stations, status_cube, date_qmj, threshold, threshold_column, threshold_value, history_days):
+    """Table of the stations under the threshold on date_qmj, and the source of their status heatmap"""
+    day = date_qmj.strftime('%_d/%m/%Y')
+    under = map_stations[f"{day}-status"]>=threshold_value
+    threshold_table = map_stations[under][['index','NOM_COMPLET',day,threshold_column,'hydrographie','UG','Unite_Gestion']].rename(columns={'NOM_COMPLET': 'nom complet',day: f'QMJ {date_qmj} [m3]', threshold_column: f'{threshold} [m3]','Unite_Gestion': 'unité de gestion'}).set_index('index')
+
+    ## Status history of the stations under the threshold, read from the status cube
+    stations_under = map_stations.loc[under, 'index']
+    history_status = status_cube.window(date_qmj, history_days)[0][status_cube.station_codes.get_indexer(stations_under)]
+    source = status_history(history_status, stations_under, [date_qmj-timedelta(i) for i in range(0,history_days)])
+    return threshold_table, source
+
+
+_state_cache = SharedCache(STATE_CACHE_MAX_BYTES)
+
+
+def _basin_state_key(status_cube, date_qmj, selected_stations):
+    # States of a day are drawn from its Qmj and those of the days before: they are kept when later days are ingested
+    return ('basin', status_cube.day_version(date_qmj), date_qmj, selected_stations)
+
+
+def get_basin_state(stations_layer, qmj_matrix, status_cube, stations, date_qmj, selected_stations=None):
+    # Shared by all sessions: the returned frames must not be modified
+    selected_stations = None if selected_stations is None else tuple(selected_stations)
+    key = _basin_state_key(status_cube, date_qmj, selected_stations)
+    return _state_cache.get(key, lambda: basin_state(stations_layer, qmj_matrix, status_cube, stations, date_qmj, selected_stations))
+
+
+def has_basin_state(status_cube, date_qmj, selected_stations=None):
+    """Whether the basin state of date_qmj is in the state cache, computed or read from a snapshot"""
+    selected_stations = None if selected_stations is None else tuple(selected_stations)
+    return _basin_state_key(status_cube, date_qmj, selected_stations) in _state_cache
+
+
+def get_threshold_state(map_stations, status_cube, date_qmj, threshold, threshold_column, threshold_value, history_days, selected_stations=None):
+    # map_stations is the one of the basin state for the same date and selected stations
+    selected_stations = None if selected_stations is None else tuple(selected_stations)
+    key = ('threshold', status_cube.day_version(date_qmj), date_qmj, threshold, history_days, selected_stations)
+    return _state_cache.get(key, lambda: threshold_state(map_stations, status_cube, date_qmj, threshold, threshold_column, threshold_value, history_days))
+
+
+def get_section(name, key, build):
+    """Object of a section of the page, e.g. a chart, built again only when key changes.
+
+    key holds everything the section is built from. Sections are shared by all
+    sessions through the state cache: don't modify what is returned.
+    """
+    return _state_cache.get(('section', name) + tuple(key), build)
+
+
+def put_states(entries):
+    """Add (key, value, size) entries computed elsewhere, e.g. read from a snapshot, to the state cache"""
+    for key, value, size in entries:
+        _state_cache.put(key, value, size)
+
+
+def drain_states():
+    """Remove the entries of the state cache, and return them as (key, value, size), e.g. to store them"""
+    return _state_cache.drain()
+
+
+def status_color(date_qmj):
+    """Colour encoding of the status of the stations on date_qmj, as on the map"""
+    scale = alt.Scale(domain=['0','1', '2', '3', '4', '5'],
+                    range=['#828282', '#88CE33','#F5DC0B','#F5860B','#E53E1D', '#000000'])
+    return alt.Color(f"{date_qmj.strftime('%_d/%m/%Y')}-status:N", scale=scale)
+
+
+def threshold_heatmap(source, date_qmj, history_days):
+    """Heatmap of the status history of the stations under a threshold, source being the one of threshold_state"""
+    return ChartSpec(alt.Chart(source).mark_square(size=min(400, 0.8*(430/(history_days+1.25))**2)).encode(
+        x=alt.X('day:T', scale=alt.Scale(domain=((date_qmj-timedelta(history_days+0.25)).strftime('%Y-%m-%d'), (date_qmj+timedelta(1)).strftime('%Y-%m-%d')))),
+        y='stations:N',
+        color=alt.Color('status:O', legend=alt.Legend(title='Débits seuils franchis'), scale=alt.Scale(domain=['0','1', '2', '3', '4', '5'], range=['#828282', '#88CE33','#F5DC0B','#F5860B','#E53E1D', '#000000'])),
+        tooltip=[
+            alt.Tooltip('stations:N', title='Station'),
+            alt.Tooltip('day:T', title='Date'),
+            alt.Tooltip('status:Q', title='Status'),
+        ]
+    ).properties(
+        width=430,
+        height=len(source['stations'].unique())*25+60
+    ).configure_axis(
+        grid=False
+    ).configure_view(
+        strokeWidth=0
+    ))
+
+
+def basin_chart(map_stations, date_qmj, bbox):
+    """Stations on their coordinates above the count of stations per status, each filtering the other"""
+    color = status_color(date_qmj)
+
+    ## We create two selections:
+    ## - a brush that is active on the top panel
+    ## - a multi-click that is active on the bottom panel
+    ## Selections are named so that the spec is the same each time the chart is built
+    brush = alt.selection(type='interval', name='zone') #alt.selection_interval(encodings=['x'])
+    click = alt.selection_multi(encodings=['color'], name='seuils')
+
+    ## Top panel is scatter plot of hydrometric stations given their longitude and latitude
+    points = alt.Chart().mark_circle().encode(
+        alt.X('X_LONG_E:Q', title='Longitude'),
+        alt.Y('Y_LAT_N:Q', title='Latitude', scale=alt.Scale(domain=[bbox[1]-0.05,bbox[3]+0.05])),
+        color=alt.condition(brush, color, alt.value('lightgray')),
+        size=alt.Size(f"{date_qmj.strftime('%_d/%m/%Y')}:Q", scale=alt.Scale(range=[20, 300])),
+        tooltip=['index',f"{date_qmj.strftime('%_d/%m/%Y')}"],
+    ).properties(
+        width=550,
+        height=300
+    ).add_selection(
+        brush
+    ).transform_filter(
+        click
+    )
+
+    ## Bottom panel is a bar chart giving the distibution of the stations according to their status
+    bars = alt.Chart().mark_bar().encode(
+        x=alt.X('count()', title='Nombre de stations par intervalle de seuils'),
+        y=alt.Y(f"{date_qmj.strftime('%_d/%m/%Y')}-status:N", scale=alt.Scale(domain=[0, 1, 2, 3, 4, 5]), title='Seuils'),
+        color=alt.condition(click, color, alt.value('lightgray')),
+    ).transform_filter(
+        brush
+    ).properties(
+        width=550,
+    ).add_selection(
+        click
+    )
+
+    ## Concat the charts
+    return ChartSpec(alt.vconcat(
+        points,
+        bars,
+        data=map_stations,
+        title="Situation du bassin"
+    ).configure_axis(
+        grid=False
+    ))
+
+
+def river_chart(topology, map_stations, date_qmj):
+    """Stations along each river, from upstream to downstream"""
+    ## Reshape to ease manipulation, following the river -> stations index
+    map_stations_river = topology.rivers_frame(map_stations)
+
+    return ChartSpec(alt.Chart(map_stations_river).mark_circle().encode(
+        alt.X('river_name:O', title='Rivières', axis=alt.Axis(labelAngle=0, orient="top")),
+        alt.Y('index:O', title=''),
+        color=status_color(date_qmj),
+        size=alt.Size(f"{date_qmj.strftime('%_d/%m/%Y')}:Q", scale=alt.Scale(range=[20, 500])),
+        tooltip=['COD_STAT',f"{date_qmj.strftime('%_d/%m/%Y')}"],
+    ).properties(
+        height=400
+    ))
+
+
+# Sections of a day, also rendered ahead by prerender.py: keyed like the basin state they are drawn from
+def get_threshold_heatmap(source, status_cube, date_qmj, threshold, history_days, selected_stations=None):
+    selected_stations = None if selected_stations is None else tuple(selected_stations)
+    key = (status_cube.day_version(date_qmj), date_qmj, threshold, history_days, selected_stations)
+    return get_section('historique des seuils', key, lambda: threshold_heatmap(source, date_qmj, history_days))
+
+
+def get_basin_chart(map_stations, status_cube, date_qmj, bbox, selected_stations=None):
+    selected_stations = None if selected_stations is None else tuple(selected_stations)
+    return get_section('situation du bassin', (status_cube.day_version(date_qmj), date_qmj, selected_stations), lambda: basin_chart(map_stations, date_qmj, bbox))
+
+
+def get_river_chart(topology, map_stations, status_cube, date_qmj, selected_stations=None):
+    selected_stations = None if selected_stations is None else tuple(selected_stations)
+    return get_section("cours d'eau", (status_cube.day_version(date_qmj), date_qmj, selected_stations), lambda: river_chart(topology, map_stations, date_qmj))
+
+
 def get_threshold(map_stations, threshold_name_dict, selected_stations):
     col_names = [threshold_name_dict[x] for x in threshold_name_dict.keys()]
     v = map_stations[map_stations['COD_STAT']==selected_stations[0]][col_names].values
@@ -110,6 +1881,6 @@ def print_stations(stations):
 
 
 def process_rivers(river, map_stations, rivers):
-    map_stations_river = map_stations.loc[map_stations['index'].isin(rivers[river])].drop(columns={'geometry'}).rename(columns={'index': 'COD_STAT'})
+    map_stations_river = map_stations.loc[map_stations['index'].isin(rivers[river])].drop(columns={'geometry'}, errors='ignore').rename(columns={'index': 'COD_STAT'})
     map_stations_river['river_name'] = river
     return map_stations_river.reset_index(drop=True).reset_index()
\ No newline at end of file